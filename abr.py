@@ -8,7 +8,7 @@ import mne
 from mne.preprocessing import ICA, create_ecg_epochs
 import matplotlib.pyplot as plt
 
-from eeg_shared import BDFWithMetadata
+from eeg_shared import BDFWithMetadata, add_processing_arguments, parse_bands
 
 parser = argparse.ArgumentParser(description='Automate FMed study artifact rejection and analysis of MMN. By default loads the file for viewing')
 
@@ -21,21 +21,22 @@ parser.add_argument('--epoch-average', action='store_true', help="Plot epoch ave
 parser.add_argument('--epoch-image', action='store_true', help="Very slow colormap image of epochs")
 parser.add_argument('--epoch-view', action='store_true', help="Simple linear view of epochs, default end view")
 parser.add_argument('--psd', metavar='HZ', action='store', help="Plot power spectral density up to HZ")
-parser.add_argument('--force', action='store_true', help="Force running outside of raw-data/subjects, saving masks to current directory")
 parser.add_argument('--save-average', action='store_true', help="Save averaged evoked epochs in a standard MNE file")
 parser.add_argument('--all', action='store_true', help="Generate all plots")
 parser.add_argument('--bandpass-from', metavar='HZ', action='store', help="Lower frequency of bandpass (default is 100)")
 parser.add_argument('--bandpass-to', metavar='HZ', action='store', help="Higher frequency of bandpass (default is 3000)")
-parser.add_argument('--no-reference', action='store_true', help="Do not reference mastoids")
-parser.add_argument('--reference-o1', action='store_true', help="Only reference o1 mastoid")
-parser.add_argument('--reference-o2', action='store_true', help="Only reference o2 mastoid")
 parser.add_argument('--display-huge', action='store_true', help="Zoom way out to display entire file")
-parser.add_argument('--no-crop', action='store_true', help="Do not crop file")
-parser.add_argument('--no-notch', action='store_true', help="Do not notch filter at 50Hz")
 
+add_processing_arguments(parser, "abr")
 
 args = parser.parse_args()
 
+# Sweeps and streamed averages never hold the epochs the plots are drawn from
+if (args.bands or args.stream_average) and any([args.topo, args.shell, args.epoch_average, args.epoch_image, args.epoch_view, args.all]):
+    parser.error("--bands and --stream-average only save averages, plot in a run without them")
+if (args.bands or args.stream_average) and not args.save_average:
+    parser.error("--bands and --stream-average only save averages, add --save-average")
+
 if args.verbose > 0:
     coloredlogs.install(level='DEBUG')
 else:                       
@@ -45,7 +46,7 @@ else:
 raw_file = args.input
 
 
-f = BDFWithMetadata(raw_file, "abr", args.force, no_reference=args.no_reference, reference_o1=args.reference_o1, reference_o2=args.reference_o2, no_notch=(args.no_notch or args.skip_view), no_crop=args.no_crop)
+f = BDFWithMetadata(raw_file, "abr", args, no_notch=(args.no_notch or args.skip_view))
 f.load()
 if args.bandpass_from:
     f.highpass = float(args.bandpass_from)
@@ -53,12 +54,24 @@ if args.bandpass_from:
 if args.bandpass_to:
     f.lowpass = float(args.bandpass_to)
     logging.info(f"Overriding lowpass frequency of band to {f.lowpass}Hz")
+if args.all_references:
+    # Every reference variant from the one load, each to its usual output path
+    bands = parse_bands(args.bands) if args.bands else None
+    f.save_reference_averages(bands=bands, threads=args.band_threads)
+    sys.exit()
 if not args.skip_view:
     f.artifact_rejection(args.display_huge)
 
 if args.psd or args.all:
     f.psd(int(args.psd or 2000))
 
+if args.bands or args.stream_average:
+    # Each band is filtered from the same preprocessed data and saved under its own name
+    bands = parse_bands(args.bands) if args.bands else None
+    f.build_epochs(bands=bands, threads=args.band_threads)
+    if args.save_average or args.all:
+        f.save_average()
+    sys.exit()
 
 epochs = f.build_epochs()
 
@@ -2,18 +2,21 @@
 
 import os
 import sys
-import glob
 import argparse
 import logging
 import coloredlogs
 import datetime
 import numpy as np
 from scipy import stats
-from scipy import integrate
 import mne
 import csv
 from statsmodels.stats.weightstats import ttest_ind
 
+from evoked_catalog import EvokedCatalog, DEFAULT_CATALOG
+import group_store
+import window_amplitude
+import time_resolved
+
 # Mutated from mmn_analysis.py and abr_grand_average.py to do ABR t-tests
 
 # Baseline to the start of the section
@@ -24,6 +27,11 @@ timestamp = datetime.datetime.now().isoformat()
 parser = argparse.ArgumentParser(description='Automate FMed study statistical analysis of MMN.')
 parser.add_argument('-v', '--verbose', action='count', default=0)
 parser.add_argument('--debug', action="store_true")
+parser.add_argument('--store', metavar='DIR', help="Read every subject's average from a group store made with --export-store instead of the FIF files")
+parser.add_argument('--export-store', metavar='DIR', help="Save every subject's average as a group store in DIR for later --store runs")
+parser.add_argument('--time-resolved', action='store_true', help="Also t test the groups at every sample of every channel, FDR corrected, saved and plotted in the stats directory")
+parser.add_argument('--fdr-alpha', metavar='ALPHA', type=float, default=0.05, help="False discovery rate for --time-resolved (default 0.05)")
+parser.add_argument('--catalog', metavar='FILE', default=DEFAULT_CATALOG, help="Catalog of saved averages to look subjects up in (build it with evoked_catalog.py)")
 # parser.add_argument('subject', nargs='+')
 
 args = parser.parse_args()
@@ -41,28 +49,39 @@ group2_name = "postmortem"
 
 
 INPUT_DIR = "/study/thukdam/analyses/eeg_statistics/abr"
+catalog = EvokedCatalog(args.catalog)
 
 logging.info(f"Reading group 1 and group 2 from {INPUT_DIR}")
 
 def load_group(group):
     total = []
-    weights = []
     for sid in group:
-        # Find the statistics files for this subject
-        path = f"{INPUT_DIR}/{sid}/*-ave.fif"
-        find = glob.glob(path)
-        if len(find) == 0:
-            logging.fatal(f"No {kind} summary file found for {sid}")
+        # Find the statistics file for this subject, in the standard band
+        total_file = catalog.find(sid, "abr", "all")
+        if total_file is None:
+            logging.fatal(f"No summary file found for {sid} in {args.catalog}")
             sys.exit(1)
-        elif len(find) > 1:
-            logging.warn(f"Multiple summary files found for {sid}, picking first")
-
-        total_file = find[0]
 
         total += mne.read_evokeds(total_file, baseline=BASELINE)
 
+    return {
+        'total': total,
+    }
+
+if args.store:
+    store = group_store.load(args.store)
+else:
+    data1 = load_group(group1)
+    data2 = load_group(group2)
+    # Same layout as the saved group store, so the rest works on either
+    store = group_store.stack(group1 + group2, {'all': data1['total'] + data2['total']})
+    if args.export_store:
+        group_store.save(args.export_store, store)
+
+def group_arrays(group):
+    total, nave = group_store.select(store, group, 'all')
+
     # Calculate weights by # of trials not rejected
-    nave = [ x.nave for x in total ]
     total_weight = sum(nave)
     weights = [ (x / total_weight) * len(nave) for x in nave ]
 
@@ -71,15 +90,16 @@ def load_group(group):
         'weights': weights,
     }
 
-data1 = load_group(group1)
-data2 = load_group(group2)
+data1 = group_arrays(group1)
+data2 = group_arrays(group2)
 
 
-def crop(electrode, evoked, window_start_ms, window_end_ms):
-    pick = evoked.ch_names.index(electrode)
+def crop(electrode, data, window_start_ms, window_end_ms):
+    # data is channel x time for one subject, or subject x channel x time
+    pick = store['ch_names'].index(electrode)
 
-    times = evoked.times
-    data = evoked.data[pick]
+    times = store['times']
+    data = data[..., pick, :]
 
     # We have to crop to the window
     window_start_s = window_start_ms / 1000
@@ -90,35 +110,35 @@ def crop(electrode, evoked, window_start_ms, window_end_ms):
     start_index = np.where(times>=window_start_s)[0][0]
     end_index = np.where(times>=window_end_s)[0][0]
 
-    data_window = data[start_index:end_index]
+    data_window = data[..., start_index:end_index]
     times_window = times[start_index:end_index]
 
     return (data_window, times_window)
 
 
-def amplitude(electrode, evoked, window_start_ms, window_end_ms):
-    data_window, times_window = crop(electrode, evoked, window_start_ms, window_end_ms)
-
+def areas(electrode, integrals, windows_ms):
+    # Area in each window for every subject, subject x window
+    pick = store['ch_names'].index(electrode)
     # Now, instead of combining the evoked data using an average,
     # we calculate area under the curve / s
     # NOTE: Pretty sure this is resulting in seconds as the unit, not ms,
     # but since that's what the MNE Evoked objects think in, seems fine
-    area = integrate.simps(data_window, times_window)
-    return area
+    return window_amplitude.window_areas(integrals, windows_ms)[:, pick]
+
 
+ABR_START = 4
+ABR_END = 8
 
-def get_amplitudes(electrode, data):
-    ABR_START = 4
-    ABR_END = 8
-    return [ amplitude(electrode, x, ABR_START, ABR_END) for x in data ]
+def get_amplitudes(electrode, integrals):
+    return list(areas(electrode, integrals, [(ABR_START, ABR_END)])[:, 0])
 
 
 
-def peak_duration(electrode, evoked,
+def peak_duration(electrode, subject_data,
         window_start_ms, window_end_ms):
 
-    window, _ = crop(electrode, evoked, window_start_ms, window_end_ms)
-    data, _ = crop(electrode, evoked, 0, 10)
+    window, _ = crop(electrode, subject_data, window_start_ms, window_end_ms)
+    data, _ = crop(electrode, subject_data, 0, 10)
 
     pos_locs, pos_mags = mne.preprocessing.peak_finder(window, extrema=1)
 
@@ -140,8 +160,6 @@ def peak_duration(electrode, evoked,
 
 
 def get_peaks(electrode, data):
-    ABR_START = 4
-    ABR_END = 8
     return [ peak_duration(electrode, x, ABR_START, ABR_END) for x in data ]
 
 
@@ -151,11 +169,15 @@ group1_peak_cz = get_peaks('Cz', data1['total'])
 group2_peak_fz = get_peaks('Fz', data2['total'])
 group2_peak_cz = get_peaks('Cz', data2['total'])
 
-group1_fz = get_amplitudes('Fz', data1['total'])
-group1_cz = get_amplitudes('Cz', data1['total'])
+# Integrate each group once, any window after that is a lookup
+group1_integrals = window_amplitude.cumulative(data1['total'], store['times'])
+group2_integrals = window_amplitude.cumulative(data2['total'], store['times'])
 
-group2_fz = get_amplitudes('Fz', data2['total'])
-group2_cz = get_amplitudes('Cz', data2['total'])
+group1_fz = get_amplitudes('Fz', group1_integrals)
+group1_cz = get_amplitudes('Cz', group1_integrals)
+
+group2_fz = get_amplitudes('Fz', group2_integrals)
+group2_cz = get_amplitudes('Cz', group2_integrals)
 
 group1_weights = data1['weights']
 group2_weights = data2['weights']
@@ -203,3 +225,11 @@ print(f"Group 1 [{group1_name}] fz peak duration mean: {np.mean(wg1f)} std: {np.
 print(f"Group 1 [{group1_name}] cz peak duration mean: {np.mean(wg1c)} std: {np.std(wg1c)}")
 print(f"Group 2 [{group2_name}] fz peak duration mean: {np.mean(wg2f)} std: {np.std(wg2f)}")
 print(f"Group 2 [{group2_name}] cz peak duration mean: {np.mean(wg2c)} std: {np.std(wg2c)}")
+
+
+if args.time_resolved:
+    result = time_resolved.group_test(data1['total'], data2['total'],
+            data1['weights'], data2['weights'], alpha=args.fdr_alpha)
+    time_resolved.save(OUTPUT_DIR, result, store['times'], store['ch_names'])
+    time_resolved.plot(OUTPUT_DIR, result, store['times'], store['ch_names'],
+            f"ABR, {group1_name} vs {group2_name}", electrodes=['Fz', 'Cz'])
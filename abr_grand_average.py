@@ -2,7 +2,6 @@
 
 import os
 import sys
-import glob
 import argparse
 import logging
 import coloredlogs
@@ -11,6 +10,8 @@ import numpy as np
 from matplotlib import pyplot as plt
 import mne
 
+from evoked_catalog import EvokedCatalog, DEFAULT_CATALOG
+
 # Baseline to the start of the section
 BASELINE = (None, 0)
 
@@ -19,6 +20,7 @@ timestamp = datetime.datetime.now().isoformat()
 parser = argparse.ArgumentParser(description='Automate FMed study grand averaging of ABR.')
 parser.add_argument('-v', '--verbose', action='count', default=0)
 parser.add_argument('-n', '--name', default=timestamp.replace(":","."))
+parser.add_argument('--catalog', metavar='FILE', default=DEFAULT_CATALOG, help="Catalog of saved averages to look subjects up in (build it with evoked_catalog.py)")
 parser.add_argument('subject', nargs='+')
 
 args = parser.parse_args()
@@ -30,6 +32,7 @@ else:
 
 
 INPUT_DIR = "/study/thukdam/analyses/eeg_statistics/abr"
+catalog = EvokedCatalog(args.catalog)
 OUTPUT_DIR = f"/scratch/dfitch/plots/{args.name}"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -43,16 +46,11 @@ logging.info(f"Reading {args.subject} from {INPUT_DIR} and writing to {OUTPUT_DI
 
 total = []
 for sid in args.subject:
-    # Find the statistics file for this subject
-    path = f"{INPUT_DIR}/{sid}/*-ave.fif"
-    find = glob.glob(path)
-    if len(find) == 0:
-        logging.fatal(f"No summary file found for {sid}")
+    # Find the statistics file for this subject, in the standard band
+    total_file = catalog.find(sid, "abr", "all")
+    if total_file is None:
+        logging.fatal(f"No summary file found for {sid} in {args.catalog}")
         sys.exit(1)
-    elif len(find) > 1:
-        logging.warn(f"Multiple summary files found for {sid}, picking first")
-
-    total_file = find[0]
 
     total += mne.read_evokeds(total_file, baseline=BASELINE)
 
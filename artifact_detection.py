@@ -0,0 +1,116 @@
+import logging
+from fractions import Fraction
+import numpy as np
+import mne
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import resample_poly
+
+# Proposes artifact annotations so nobody has to drag out every bad segment
+# by hand. Each channel is cut into overlapping windows and a window is bad
+# if any channel in it is
+#   - too big (peak-to-peak over PEAK_TO_PEAK_UV),
+#   - flat (peak-to-peak under FLAT_UV, e.g. a loose electrode), or
+#   - jumping (changing by more than GRADIENT_UV_PER_MS within 1ms).
+# Runs of bad windows become BAD_auto_* annotations, which load_annotations
+# and epoch rejection treat like hand-made ones.
+#
+# Checks run on a copy brought down to DETECTION_SFREQ and highpassed like the
+# artifact view, so slow drift and high frequency noise at 16kHz don't count.
+
+PEAK_TO_PEAK_UV = 150
+FLAT_UV = 1
+GRADIENT_UV_PER_MS = 50
+
+DETECTION_SFREQ = 1000
+DETECTION_HIGHPASS = 0.5
+
+WINDOW_SECONDS = 0.2
+# Windows start every half window
+WINDOW_STEPS = 2
+
+
+def block_extremes(data, step):
+    # Max and min of each channel in consecutive blocks of step samples,
+    # dropping the ragged end
+    n_blocks = data.shape[1] // step
+    blocks = data[:, :n_blocks * step].reshape(data.shape[0], n_blocks, step)
+    return blocks.max(axis=2), blocks.min(axis=2)
+
+
+def window_metrics(data, sfreq):
+    """
+    Peak-to-peak and biggest change over 1ms (in volts) of every channel in
+    every window, all at once. Returns (ptp, gradient, step) where the metric
+    arrays are (channels, windows) and window i starts at sample i*step.
+    """
+    step = max(int(round(WINDOW_SECONDS * sfreq / WINDOW_STEPS)), 1)
+    high, low = block_extremes(data, step)
+    # Over a fixed 1ms rather than per sample, so the threshold means the
+    # same thing at 512Hz and 16kHz
+    lag = max(int(round(sfreq / 1000)), 1)
+    change = np.zeros(data.shape)
+    change[:, lag:] = np.abs(data[:, lag:] - data[:, :-lag])
+    slope, _ = block_extremes(change, step)
+
+    # A window is WINDOW_STEPS consecutive blocks
+    high = sliding_window_view(high, WINDOW_STEPS, axis=1).max(axis=2)
+    low = sliding_window_view(low, WINDOW_STEPS, axis=1).min(axis=2)
+    slope = sliding_window_view(slope, WINDOW_STEPS, axis=1).max(axis=2)
+    return high - low, slope, step
+
+
+def runs(flags):
+    # Start and stop (exclusive) index of each run of True
+    edges = np.diff(np.concatenate([[0], flags.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def detection_copy(raw, pick):
+    # One channel, anti-aliased down to about DETECTION_SFREQ and highpassed
+    sfreq = raw.info['sfreq']
+    data = raw._data[pick]
+    if sfreq > DETECTION_SFREQ:
+        ratio = Fraction(DETECTION_SFREQ / sfreq).limit_denominator(1000)
+        data = resample_poly(data, ratio.numerator, ratio.denominator)
+        sfreq = sfreq * ratio.numerator / ratio.denominator
+    data = mne.filter.filter_data(data[np.newaxis, :], sfreq, DETECTION_HIGHPASS, None,
+            fir_design='firwin', verbose=False)
+    return data, sfreq
+
+
+def detect(raw, picks=None, peak_to_peak_uv=PEAK_TO_PEAK_UV, flat_uv=FLAT_UV,
+        gradient_uv_per_ms=GRADIENT_UV_PER_MS):
+    """
+    Propose annotations for the bad stretches of raw, looking only at the
+    picked channels (all EEG by default).
+    """
+    if picks is None:
+        picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    else:
+        picks = mne.pick_channels(raw.ch_names, picks, ordered=True)
+    # A channel at a time keeps the temporary arrays small at 16kHz
+    metrics = []
+    for pick in picks:
+        data, sfreq = detection_copy(raw, pick)
+        metrics.append(window_metrics(data, sfreq))
+    ptp = np.concatenate([m[0] for m in metrics])
+    gradient = np.concatenate([m[1] for m in metrics])
+    step = metrics[0][2]
+
+    checks = {
+        'BAD_auto_peak_to_peak': ptp > peak_to_peak_uv * 1e-6,
+        'BAD_auto_flat': ptp < flat_uv * 1e-6,
+        'BAD_auto_gradient': gradient > gradient_uv_per_ms * 1e-6,
+    }
+    window_samples = step * WINDOW_STEPS
+    onsets, durations, descriptions = [], [], []
+    for description, bad in checks.items():
+        starts, stops = runs(bad.any(axis=0))
+        # Window indices to seconds, a run ends where its last window ends
+        onsets.append(raw.first_time + starts * step / sfreq)
+        durations.append(((stops - 1 - starts) * step + window_samples) / sfreq)
+        descriptions += [description] * len(starts)
+        logging.info(f"{description}: {len(starts)} segments, {np.sum(durations[-1]):.1f}s")
+
+    return mne.Annotations(np.concatenate(onsets), np.concatenate(durations),
+            descriptions, orig_time=raw.info['meas_date'])
@@ -0,0 +1,76 @@
+import logging
+import numpy as np
+
+# The artifact mask CSV (annotations dragged out in the artifact view) compiled
+# into sorted, non-overlapping intervals, so every epoch can be checked
+# against it in one go instead of MNE checking each epoch against every
+# annotation.
+#
+# An epoch is rejected when it overlaps any annotation whose description
+# starts with "bad" (any case), the same rule as reject_by_annotation in
+# mne.Epochs.
+
+
+def bad_intervals(raw):
+    """
+    Compile the "bad" annotations on raw into sorted, merged [start, stop)
+    intervals, in (fractional) samples from the first sample of raw.
+    """
+    annotations = raw.annotations
+    bad = np.array([d.lower().startswith('bad') for d in annotations.description], dtype=bool)
+    sfreq = raw.info['sfreq']
+    starts = (np.asarray(annotations.onset, dtype=float)[bad] - raw.first_time) * sfreq
+    stops = starts + np.asarray(annotations.duration, dtype=float)[bad] * sfreq
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+    # A new interval starts wherever an annotation begins after every earlier one ended
+    reach = np.maximum.accumulate(stops)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(starts)) - 1
+    return starts[first], reach[last]
+
+
+def reject_windows(intervals, starts, stops):
+    """
+    Flag every sample window [start, stop) that overlaps a bad interval.
+    """
+    bad_starts, bad_stops = intervals
+    if len(bad_starts) == 0:
+        return np.zeros(len(starts), dtype=bool)
+    # Intervals are disjoint and sorted, so only the last one starting
+    # before the window ends can reach into it
+    i = np.searchsorted(bad_starts, stops, side='left') - 1
+    return (i >= 0) & (bad_stops[np.maximum(i, 0)] > starts)
+
+
+def reject_events(raw, events, tmin, tmax):
+    """
+    Flag the events whose tmin..tmax epoch overlaps a bad annotation.
+    """
+    sfreq = raw.info['sfreq']
+    starts = np.round(events[:, 0] + int(round(tmin * sfreq))).astype(int) - raw.first_samp
+    stops = starts + int(round(tmax * sfreq)) - int(round(tmin * sfreq)) + 1
+    return reject_windows(bad_intervals(raw), starts, stops)
+
+
+def condition_counts(events, rejected, event_id, conditions):
+    """
+    How many epochs each condition had and how many were rejected.
+
+    conditions maps a condition name to the event names it covers, like
+    average_conditions() in eeg_shared.
+    """
+    counts = {}
+    for name, wanted in conditions.items():
+        codes = [event_id[w] for w in wanted]
+        in_condition = np.isin(events[:, 2], codes)
+        total = int(np.sum(in_condition))
+        bad = int(np.sum(in_condition & rejected))
+        counts[name] = {'total': total, 'rejected': bad, 'kept': total - bad}
+        logging.info(f"Rejected {bad} of {total} {name} epochs overlapping bad annotations")
+    return counts
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import errno
+import time
+import argparse
+import logging
+import resource
+import datetime
+import coloredlogs
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from eeg_shared import BDFWithMetadata, NeedsManualReview, parse_bands, expand_inputs, add_processing_arguments, processing_options
+import tone_sequences
+
+# Runs the same path as `mmn.py --skip-view --save-average` and
+# `abr.py --skip-view --save-average` over a whole cohort of BDF files,
+# one file and paradigm per worker process.
+
+KINDS = ["mmn", "abr"]
+
+
+def init_worker(memory_limit_gb, verbose):
+    if verbose > 0:
+        coloredlogs.install(level='DEBUG')
+    else:
+        coloredlogs.install(level='INFO')
+
+    if memory_limit_gb:
+        # Cap the data segment so one huge file fails with a MemoryError
+        # instead of taking the whole analysis node down with it. Unlike
+        # RLIMIT_AS this leaves out read-only maps like the BDF records
+        # (bdf_reader.records) and address space reserved but never written,
+        # but on Linux it does count private writable maps, so copy on write
+        # loads from the preprocessed cache count in full.
+        limit = int(memory_limit_gb * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def process_file(path, kind, options, bands, band_threads):
+    """
+    Load, epoch and save averages for one file, the same as the
+    --skip-view --save-average path of mmn.py and abr.py.
+
+    Returns a summary row for the batch report.
+    """
+    start = time.time()
+    status = "ok"
+    message = ""
+    dropped_events = ""
+    staging = ""
+    try:
+        # --skip-view also turns off the notch in mmn.py and abr.py
+        f = BDFWithMetadata(path, kind, options,
+                no_notch=True,
+                interactive=False,
+                epoch_local_filter=options['epoch_local_filter'] and kind == "abr",
+                resample_sfreq=options['resample_sfreq'] if kind == "mmn" else None)
+        f.load()
+        if f.dropped_events is not None:
+            dropped_events = f.dropped_events
+        if f.staging_hit is not None:
+            staging = "hit" if f.staging_hit else "miss"
+        if options['all_references']:
+            f.save_reference_averages(bands=bands, threads=band_threads)
+        else:
+            f.build_epochs(bands=bands, threads=band_threads)
+            if f.is_mmn():
+                f.decimate_epochs()
+            f.save_average()
+    except NeedsManualReview as e:
+        status = "needs_review"
+        message = str(e)
+        logging.warning(message)
+    except SystemExit as e:
+        # eeg_shared exits when it can't continue, it has already logged why
+        status = "failed"
+        message = f"exited with status {e.code}"
+    except MemoryError:
+        status = "failed"
+        message = "ran out of memory, try a larger --memory-limit"
+        logging.error(f"{message} on {path}")
+    except Exception as e:
+        status = "failed"
+        if isinstance(e, OSError) and e.errno == errno.ENOMEM:
+            # Memory mapping a cached copy past the limit fails this way
+            message = "ran out of memory, try a larger --memory-limit"
+            logging.error(f"{message} on {path}")
+        else:
+            message = f"{type(e).__name__}: {e}"
+            logging.exception(f"Failed processing {kind} for {path}")
+
+    return {
+        'path': path,
+        'kind': kind,
+        'status': status,
+        'seconds': round(time.time() - start, 2),
+        'dropped_events': dropped_events,
+        'staging': staging,
+        'message': message,
+    }
+
+
+def main():
+    timestamp = datetime.datetime.now().isoformat()
+
+    parser = argparse.ArgumentParser(description='Run FMed study MMN and ABR averaging headless over a cohort of BDF files in parallel.')
+
+    parser.add_argument('input', nargs='*', help='BDF paths or glob patterns (quote globs so the shell does not expand them)')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-m', '--manifest', action='append', default=[], help="File listing one BDF path or glob per line, can be given more than once")
+    parser.add_argument('-k', '--kind', choices=KINDS + ["both"], default="both", help="Which paradigm to process (default both)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default is one per core)")
+    parser.add_argument('--memory-limit', metavar='GB', type=float, help="Maximum heap and other private writable memory per worker process in GB. Read-only memory maps of the BDFs don't count, copy on write loads from --cache-dir do")
+    parser.add_argument('--summary', metavar='CSV', default=f"batch_summary_{timestamp.replace(':', '.')}.csv", help="Where to write the per-file summary")
+    # No view, so no --no-notch or --no-crop, --band-threads and --jobs are per worker
+    add_processing_arguments(parser, viewing=False)
+
+    args = parser.parse_args()
+
+    if args.verbose > 0:
+        coloredlogs.install(level='DEBUG')
+    else:
+        coloredlogs.install(level='INFO')
+
+    paths = expand_inputs(args.input, args.manifest)
+    if len(paths) == 0:
+        logging.fatal("No input files found, exiting!")
+        sys.exit(1)
+
+    kinds = KINDS if args.kind == "both" else [args.kind]
+    options = processing_options(args)
+    bands = parse_bands(args.bands) if args.bands else None
+
+    if "mmn" in kinds:
+        # Compile the tone sequences once up front so workers just load the index
+        tone_sequences.load_index(os.path.join(sys.path[0], 'MMN_tone_sequences'))
+
+    jobs = [(p, k) for p in paths for k in kinds]
+    logging.info(f"Processing {len(jobs)} jobs from {len(paths)} files with {args.workers} workers")
+
+    counts = {}
+    staging_counts = {}
+    start = time.time()
+    fields = ['path', 'kind', 'status', 'seconds', 'dropped_events', 'staging', 'message']
+    with open(args.summary, 'w', newline='') as csvfile:
+        out = csv.DictWriter(csvfile, fieldnames=fields)
+        out.writeheader()
+
+        # One task per child so memory from a big file is handed back
+        # to the OS before the next one starts
+        with ProcessPoolExecutor(max_workers=args.workers,
+                initializer=init_worker,
+                initargs=(args.memory_limit, args.verbose),
+                max_tasks_per_child=1) as pool:
+            futures = {pool.submit(process_file, p, k, options, bands, args.band_threads): (p, k) for (p, k) in jobs}
+            for future in as_completed(futures):
+                path, kind = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:
+                    # The worker itself died, most likely killed for memory
+                    row = {'path': path, 'kind': kind, 'status': 'failed',
+                            'seconds': '', 'dropped_events': '', 'staging': '', 'message': f"worker crashed: {type(e).__name__}: {e}"}
+                out.writerow(row)
+                csvfile.flush()
+                counts[row['status']] = counts.get(row['status'], 0) + 1
+                if row['staging']:
+                    staging_counts[row['staging']] = staging_counts.get(row['staging'], 0) + 1
+                logging.info(f"[{sum(counts.values())}/{len(jobs)}] {row['status']} {kind} {path} in {row['seconds']}s")
+
+    elapsed = time.time() - start
+    logging.info(f"Finished {len(jobs)} jobs in {elapsed:.1f}s: {counts}")
+    if args.staging_dir:
+        logging.info(f"Staging cache: {staging_counts.get('hit', 0)} hits, {staging_counts.get('miss', 0)} misses")
+    logging.info(f"Wrote summary to {args.summary}")
+    if counts.get('needs_review'):
+        logging.warning(f"{counts['needs_review']} jobs need start and stop times picked by hand, run mmn.py or abr.py on them interactively")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import os
+import logging
+from datetime import datetime, timezone
+import numpy as np
+import mne
+
+# A small BDF reader that only decodes the channels and samples we actually use,
+# straight from the 24-bit data records. mne.io.read_raw_bdf loads every channel
+# (including the duplicated EXG*-0/EXG*-1 set in the 17 channel files) for the
+# whole recording before we get a chance to crop.
+#
+# BDF layout: a 256 byte fixed header, then 256 bytes per signal, then data
+# records. Each record holds n_samples[i] 3-byte little endian samples for
+# each signal i in turn.
+
+EXG_CHANNELS = ['EXG1', 'EXG2', 'EXG3', 'EXG4', 'EXG5', 'EXG6']
+STATUS_CHANNEL = 'Status'
+
+# MNE keeps the low 17 bits of the Biosemi Status channel as trigger values
+STATUS_MASK = 2**17 - 1
+
+# How many data records to decode at once, keeps temporary arrays small
+RECORDS_PER_CHUNK = 64
+
+UNIT_SCALES = {
+    'uV': 1e-6,
+    'µV': 1e-6,
+    'μV': 1e-6,
+    'mV': 1e-3,
+}
+
+
+def read_header(path):
+    with open(path, 'rb') as file:
+        fixed = file.read(256)
+        header_bytes = int(fixed[184:192])
+        n_records = int(fixed[236:244])
+        record_seconds = float(fixed[244:252])
+        n_signals = int(fixed[252:256])
+
+        def fields(width):
+            raw = file.read(width * n_signals)
+            return [raw[i*width:(i+1)*width].decode('latin-1').strip() for i in range(n_signals)]
+
+        labels = fields(16)
+        fields(80)  # transducer
+        units = fields(8)
+        physical_min = np.array(fields(8), float)
+        physical_max = np.array(fields(8), float)
+        digital_min = np.array(fields(8), float)
+        digital_max = np.array(fields(8), float)
+        fields(80)  # prefiltering
+        n_samples = np.array(fields(8), int)
+
+    # Start date is dd.mm.yy and time is hh.mm.ss, same two digit year
+    # handling as MNE
+    day, month, year = [int(x) for x in fixed[168:176].decode('latin-1').split('.')]
+    hour, minute, second = [int(x) for x in fixed[176:184].decode('latin-1').split('.')]
+    year += 2000 if year < 85 else 1900
+    meas_date = datetime(year, month, day, hour, minute, second, tzinfo=timezone.utc)
+
+    record_bytes = int(n_samples.sum()) * 3
+    # The last record may be partial or the header may say -1 if the
+    # recording was not closed cleanly, so trust the file size
+    available = (os.path.getsize(path) - header_bytes) // record_bytes
+    if n_records < 0 or n_records > available:
+        logging.warning(f"BDF header says {n_records} records but file has {available}, using {available}")
+        n_records = available
+
+    cal = (physical_max - physical_min) / (digital_max - digital_min)
+    return {
+        'path': path,
+        'header_bytes': header_bytes,
+        'n_records': n_records,
+        'record_seconds': record_seconds,
+        'labels': labels,
+        'units': units,
+        'cal': cal,
+        'offsets': physical_min - digital_min * cal,
+        'n_samples': n_samples,
+        # Byte offset of each signal inside a record
+        'signal_offsets': np.concatenate([[0], np.cumsum(n_samples)[:-1]]) * 3,
+        'record_bytes': record_bytes,
+        'meas_date': meas_date,
+    }
+
+
+def channel_index(header, name):
+    # The 17 channel files have the EXG channels twice, MNE calls the first
+    # set EXG1-0 etc. and that's the one we use, so take the first match
+    return header['labels'].index(name)
+
+
+def sampling_rate(header, index):
+    return header['n_samples'][index] / header['record_seconds']
+
+
+def records(header):
+    return np.memmap(header['path'], dtype=np.uint8, mode='r',
+            offset=header['header_bytes'],
+            shape=(header['n_records'], header['record_bytes']))
+
+
+def decode_int24(chunk):
+    # chunk is (..., n*3) uint8, returns (..., n) int32 with sign extension
+    b = chunk.reshape(chunk.shape[:-1] + (-1, 3)).astype(np.int32)
+    values = b[..., 0] | (b[..., 1] << 8) | (b[..., 2] << 16)
+    values <<= 8
+    values >>= 8
+    return values
+
+
+def read_samples(header, indices, start, stop, mm=None):
+    """
+    Decode samples [start, stop) of the given signal indices.
+
+    All signals must share a sampling rate. Returns digital values as
+    int32, shape (len(indices), stop - start).
+    """
+    spr = int(header['n_samples'][indices[0]])
+    if any(header['n_samples'][i] != spr for i in indices):
+        raise ValueError("Can only read signals with matching sampling rates together")
+
+    total = header['n_records'] * spr
+    start = max(int(start), 0)
+    stop = min(int(stop), total)
+    out = np.empty((len(indices), max(stop - start, 0)), dtype=np.int32)
+    if stop <= start:
+        return out
+
+    if mm is None:
+        mm = records(header)
+
+    first_record = start // spr
+    last_record = (stop - 1) // spr + 1
+    written = 0
+    for r in range(first_record, last_record, RECORDS_PER_CHUNK):
+        r_end = min(r + RECORDS_PER_CHUNK, last_record)
+        # Sample range covered by these records, trimmed to what was asked for
+        lo = max(start - r * spr, 0)
+        hi = min(stop - r * spr, (r_end - r) * spr)
+        n = hi - lo
+        for row, i in enumerate(indices):
+            offset = header['signal_offsets'][i]
+            chunk = mm[r:r_end, offset:offset + spr * 3]
+            out[row, written:written + n] = decode_int24(chunk).ravel()[lo:hi]
+        written += n
+    return out
+
+
+def to_physical(header, indices, digital):
+    # Same calibration MNE uses, ending up in volts
+    data = digital.astype(np.float64)
+    for row, i in enumerate(indices):
+        data[row] *= header['cal'][i]
+        data[row] += header['offsets'][i]
+        data[row] *= UNIT_SCALES.get(header['units'][i], 1)
+    return data
+
+
+def read_status(header):
+    """
+    Decode only the Status channel for the whole recording.
+
+    Returns the sampling rate and the masked trigger values.
+    """
+    status = channel_index(header, STATUS_CHANNEL)
+    total = header['n_records'] * int(header['n_samples'][status])
+    values = read_samples(header, [status], 0, total)[0]
+    values &= STATUS_MASK
+    return sampling_rate(header, status), values
+
+
+def find_events(status, first_samp=0, shortest_event=2, min_samples=0):
+    """
+    Find trigger onsets in a decoded Status channel.
+
+    Gives the same result as mne.find_events with its defaults
+    (consecutive='increasing', output='onset'), but works on the plain
+    array so we don't need a Raw object with all the EEG in it.
+
+    Triggers that hold their value for fewer than min_samples samples are
+    dropped as glitches. Returns the events and how many were dropped.
+    """
+    status = np.abs(status.astype(np.int64))
+    if len(status) == 0:
+        return np.empty((0, 3), dtype=np.int64), 0
+
+    # Every sample where the value changes, plus a drop back to 0 after the end
+    changed = np.flatnonzero(np.diff(status))
+    pre = status[changed]
+    post = status[changed + 1]
+    samples = changed + 1 + first_samp
+    if status[-1] != 0:
+        samples = np.append(samples, len(status) + first_samp)
+        pre = np.append(pre, status[-1])
+        post = np.append(post, 0)
+
+    if status[0] != 0:
+        logging.info(f"Status channel has a non-zero initial value of {status[0]}")
+
+    onsets = post > pre
+    offsets = (onsets | (post == 0)) & (pre > 0)
+    onset_idx = np.flatnonzero(onsets)
+    offset_idx = np.flatnonzero(offsets)
+    if len(onset_idx) == 0 or len(offset_idx) == 0:
+        return np.empty((0, 3), dtype=np.int64), 0
+
+    # Drop orphaned offsets at the start and onsets at the end
+    if onset_idx[0] > offset_idx[0]:
+        offset_idx = offset_idx[1:]
+    if len(offset_idx) == 0 or onset_idx[-1] > offset_idx[-1]:
+        onset_idx = onset_idx[:-1]
+
+    dropped = 0
+    if min_samples > 0:
+        # Run length of each value is the distance to the next change
+        lengths = np.diff(np.append(samples, len(status) + first_samp))
+        glitch = lengths[onset_idx] < min_samples
+        dropped = int(np.sum(glitch))
+        onset_idx = onset_idx[~glitch]
+
+    events = np.column_stack([samples[onset_idx], pre[onset_idx], post[onset_idx]])
+
+    n_short = np.sum(np.diff(events[:, 0]) < shortest_event)
+    if n_short > 0:
+        raise ValueError(f"You have {n_short} events shorter than the shortest_event.")
+
+    if min_samples > 0:
+        logging.info(f"Dropped {dropped} triggers shorter than {min_samples} samples")
+    logging.info(f"{len(events)} events found on {STATUS_CHANNEL}")
+    return events, dropped
+
+
+def read_raw_subset(path, channels=EXG_CHANNELS, tmin=None, tmax=None, header=None):
+    """
+    Read only the given EEG channels plus Status into a preloaded RawArray.
+
+    tmin and tmax are in seconds from the start of the recording and behave
+    like Raw.crop, including the sample at tmax. The returned raw has its
+    first_samp set to match, so event sample numbers line up with events
+    found on the full file.
+    """
+    if header is None:
+        header = read_header(path)
+    eeg = [channel_index(header, c) for c in channels]
+    status = channel_index(header, STATUS_CHANNEL)
+    sfreq = sampling_rate(header, eeg[0])
+
+    start = 0 if tmin is None else int(round(tmin * sfreq))
+    stop = header['n_records'] * int(header['n_samples'][eeg[0]])
+    if tmax is not None:
+        stop = min(int(round(tmax * sfreq)) + 1, stop)
+
+    logging.info(f"Reading {len(channels)} channels and Status, samples {start} to {stop} of {path}")
+    mm = records(header)
+    data = to_physical(header, eeg, read_samples(header, eeg, start, stop, mm))
+    stim = read_samples(header, [status], start, stop, mm) & STATUS_MASK
+    data = np.concatenate([data, stim.astype(np.float64)])
+    del mm
+
+    info = mne.create_info(list(channels) + [STATUS_CHANNEL], sfreq,
+            ch_types=['eeg'] * len(channels) + ['stim'])
+    raw = mne.io.RawArray(data, info, first_samp=start, verbose=False)
+    raw.set_meas_date(header['meas_date'])
+    return raw
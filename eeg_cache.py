@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import yaml
+import numpy as np
+import mne
+
+# Reflinks are a Linux ioctl, elsewhere staging always copies
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# On-disk cache of preprocessed continuous data, so re-plotting or
+# re-averaging a subject can skip reading, referencing and filtering the BDF.
+#
+# Entries are keyed by the source file's path, size and mtime plus every
+# parameter that changes the data, so nothing is read from the share just to
+# look an entry up. Each entry is a directory holding the data as a
+# plain .npy (opened memory-mapped), the measurement info as a FIF and a
+# little yaml with the first sample. Least recently used entries are evicted
+# once the cache grows past its size limit.
+#
+# StagingCache below keeps local copies of the raw BDFs themselves, evicted
+# the same way.
+
+DEFAULT_CACHE_SIZE_GB = 50
+DEFAULT_STAGING_SIZE_GB = 20
+
+# ioctl asking a copy-on-write filesystem (btrfs, xfs) to share the blocks
+FICLONE = 0x40049409
+STAGED_NAME = "source.bdf"
+
+
+def source_description(path):
+    # Stands in for the file contents, a file changed on the share gets new keys
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def touch(path):
+    # Entry directory mtime doubles as the last used time for LRU eviction
+    now = time.time()
+    os.utime(path, (now, now))
+
+
+def evict_lru(cache_dir, max_bytes, keep=None):
+    """
+    Remove the least recently used entries of cache_dir until it is under
+    max_bytes. Entries are mostly subdirectories, but loose files count and
+    go the same way. Returns how many entries were removed.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # Skip entries another process is still writing
+        if name.endswith(".tmp"):
+            continue
+        try:
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), path, directory_size(path)))
+            else:
+                entries.append((os.path.getmtime(path), path, os.path.getsize(path)))
+        except OSError:
+            # Evicted by another process while we looked
+            continue
+
+    total = sum(e[2] for e in entries)
+    removed = 0
+    for mtime, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        logging.info(f"Evicting {path} from cache")
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+    return removed
+
+
+class PreprocessedCache():
+    def __init__(self, cache_dir, max_gb=DEFAULT_CACHE_SIZE_GB):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, source_path, params):
+        description = dict(params, source=source_description(source_path))
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        path = self.entry_path(key)
+        meta_file = os.path.join(path, "meta.yaml")
+        if not os.path.exists(meta_file):
+            return None
+
+        with open(meta_file) as file:
+            meta = yaml.load(file, Loader=yaml.FullLoader)
+        info = mne.io.read_info(os.path.join(path, "info.fif"))
+        # Copy on write, so in-place filtering doesn't touch the cached file
+        data = np.load(os.path.join(path, "data.npy"), mmap_mode='c')
+        raw = mne.io.RawArray(data, info, first_samp=meta['first_samp'], verbose=False)
+        touch(path)
+        logging.info(f"Loaded preprocessed data from cache {path}")
+        return raw
+
+    def save(self, key, raw, description=None):
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        np.save(os.path.join(tmp_path, "data.npy"), raw.get_data())
+        mne.io.write_info(os.path.join(tmp_path, "info.fif"), raw.info)
+        with open(os.path.join(tmp_path, "meta.yaml"), 'w') as file:
+            yaml.dump({'first_samp': int(raw.first_samp), 'description': description}, file)
+
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another process wrote the same entry meanwhile, either copy is fine
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        logging.info(f"Saved preprocessed data to cache {path}")
+
+        evict_lru(self.cache_dir, self.max_bytes, keep=path)
+
+
+def clone_or_copy(source, dest):
+    # Reflink when the scratch directory shares a copy-on-write filesystem
+    # with the source, otherwise a plain copy
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflinked"
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+    return "copied"
+
+
+class StagingCache():
+    """
+    Local scratch copies of raw BDF files from the network share, so
+    rerunning a subject reads from local disk instead of pulling the whole
+    file again.
+
+    Entries are keyed by the source path, size and mtime, so a file that
+    changes on the share is staged again. Only reading goes through the
+    staged copy, everything saved is still named after the source path.
+    """
+
+    def __init__(self, staging_dir, max_gb=DEFAULT_STAGING_SIZE_GB):
+        self.staging_dir = os.path.abspath(os.path.expanduser(staging_dir))
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def key(self, source_path):
+        description = source_description(source_path)
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def stage(self, source_path):
+        """
+        Path of a local copy of source_path, staging it first if needed.
+        Returns (path, hit).
+        """
+        path = os.path.join(self.staging_dir, self.key(source_path))
+        staged = os.path.join(path, STAGED_NAME)
+        if os.path.exists(staged):
+            touch(path)
+            logging.info(f"Staging cache hit for {source_path}")
+            return staged, True
+
+        start = time.time()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        how = clone_or_copy(source_path, os.path.join(tmp_path, STAGED_NAME))
+        with open(os.path.join(tmp_path, "source.yaml"), 'w') as file:
+            yaml.dump({'source_path': source_path}, file)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another process staged the same file meanwhile, either copy is fine
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        logging.info(f"Staging cache miss for {source_path}, {how} to {path} in {time.time() - start:.1f}s")
+
+        evict_lru(self.staging_dir, self.max_bytes, keep=path)
+        return staged, False
@@ -1,15 +1,37 @@
 import os
 import sys
-import csv
+import glob
+import argparse
+import time
+import socket
 import numpy as np
 import logging
 import yaml
 import pytz
 from pathlib import Path
 from datetime import datetime, timedelta
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 import mne
 
+import bdf_reader
+import eeg_cache
+import eeg_filters
+import streaming_average
+import artifact_mask
+import artifact_detection
+import envelope_view
+import evoked_catalog
+import tone_sequences
+
+# joblib lets MNE's filters and PSD run on several threads (--jobs),
+# without it they warn and stay on one core
+try:
+    from joblib import parallel_backend
+except ImportError:
+    parallel_backend = None
+
 # How wide of a buffer around the crop do we want?
 # 1 second is enough with .5s epochs
 BUFFER_SECONDS = 1
@@ -20,6 +42,12 @@ LOWPASS_MMN = 35
 HIGHPASS_ABR = 100
 LOWPASS_ABR = 3000
 
+# Channels that end up in the epochs, the mastoids are only for referencing
+EPOCH_CHANNELS = ['Cz', 'Fz', 'Pz', 'T8']
+
+# Channels shown in the artifact view, in order
+VIEW_ORDER = [1, 2, 3, 0, 4, 5]
+
 # Event IDs
 UNKNOWN = 1
 STANDARD = 2
@@ -30,20 +58,289 @@ EVENT_COLORS = {
     DEVIANT: "red"
 }
 
+
+# Seconds per million channel samples of each stage with one job, per
+# machine, what runs with more --jobs report their speedup against
+DEFAULT_STAGE_REFERENCE = os.path.expanduser("~/.cache/thukdam/stage_times.yaml")
+
+# Both mastoids, O1 only, O2 only as (reference_o1, reference_o2)
+REFERENCE_VARIANTS = [(False, False), (True, False), (False, True)]
+
+
+# Everything that changes how BDFWithMetadata loads and processes a file,
+# with its default. add_processing_arguments adds the command line flags for
+# them (dest is the key), processing_options reads them back.
+PROCESSING_DEFAULTS = {
+    'force': False,
+    'is_2013I': False,
+    'no_reference': False,
+    'reference_o1': False,
+    'reference_o2': False,
+    'no_notch': False,
+    'no_crop': False,
+    'fast_read': False,
+    'best_fit_block': False,
+    'min_trigger_samples': 0,
+    'match_tones': False,
+    'cache_dir': None,
+    'cache_size_gb': eeg_cache.DEFAULT_CACHE_SIZE_GB,
+    'staging_dir': None,
+    'staging_size_gb': eeg_cache.DEFAULT_STAGING_SIZE_GB,
+    'catalog_path': evoked_catalog.DEFAULT_CATALOG,
+    'all_references': False,
+    'epoch_local_filter': False,
+    'resample_sfreq': None,
+    'fused_filter': False,
+    'jobs': 1,
+    'stage_reference_path': DEFAULT_STAGE_REFERENCE,
+    'stream_average': False,
+    'auto_artifacts': False,
+}
+
+
+def add_processing_arguments(parser, kind=None, viewing=True, averaging=True):
+    """
+    Add the loading and processing flags shared by mmn.py, abr.py, batch.py
+    and review.py. kind leaves out flags for the other paradigm (None keeps
+    both), viewing adds the ones that only make sense with the view
+    (--no-notch, --no-crop) and averaging the ones for saving averages.
+    """
+    mmn = kind in (None, "mmn")
+    abr = kind in (None, "abr")
+    parser.add_argument('--force', action='store_true', help="Force running outside of raw-data/subjects, saving masks to current directory")
+    if mmn:
+        parser.add_argument('--initial-laptop', dest='is_2013I', action='store_true', help="Data is from 2013I (initial settings) north laptop after restore")
+    parser.add_argument('--no-reference', action='store_true', help="Do not reference mastoids")
+    parser.add_argument('--reference-o1', action='store_true', help="Only reference o1 mastoid")
+    parser.add_argument('--reference-o2', action='store_true', help="Only reference o2 mastoid")
+    if viewing:
+        parser.add_argument('--no-crop', action='store_true', help="Do not crop file")
+        parser.add_argument('--no-notch', action='store_true', help="Do not notch filter at 50Hz")
+    parser.add_argument('--fast-read', action='store_true', help="Only read the EXG and Status channels inside the crop, straight from the BDF")
+    parser.add_argument('--best-fit-block', action='store_true', help="When several event blocks match, crop to the one closest to the expected duration instead of the earliest")
+    parser.add_argument('--min-trigger-samples', metavar='N', type=int, default=0, help="Drop triggers lasting fewer than N samples as glitches (South computer has 2-3 sample ones)")
+    if mmn:
+        parser.add_argument('--match-tones', action='store_true', help="Pick the MMN tone sequence from the oddball double clicks (2014 dpdb02 recordings) when they match clearly, instead of day of year")
+        parser.add_argument('--resample', dest='resample_sfreq', metavar='HZ', type=float, help="Resample MMN data to HZ (e.g. 512) right after cropping, instead of decimating epochs at the end")
+    parser.add_argument('--cache-dir', metavar='DIR', action='store', help="Cache preprocessed data here so later runs skip straight to epoching")
+    parser.add_argument('--cache-size', dest='cache_size_gb', metavar='GB', type=float, default=eeg_cache.DEFAULT_CACHE_SIZE_GB, help="Maximum size of the preprocessed cache (default %(default)sGB)")
+    parser.add_argument('--staging-dir', metavar='DIR', action='store', help="Copy raw BDFs to this local scratch directory and read them from there on later runs")
+    parser.add_argument('--staging-size', dest='staging_size_gb', metavar='GB', type=float, default=eeg_cache.DEFAULT_STAGING_SIZE_GB, help="Maximum size of the staging directory (default %(default)sGB)")
+    parser.add_argument('--catalog', dest='catalog_path', metavar='FILE', default=evoked_catalog.DEFAULT_CATALOG, help="Record saved averages in this catalog for the group scripts (default %(default)s)")
+    parser.add_argument('--fused-filter', action='store_true', help="Do the 50Hz notch and the bandpass as one filter when epoching (the view and PSD show the data before the notch)")
+    parser.add_argument('--jobs', metavar='N', type=int, default=1, help="Filter channels and estimate the PSD in N threads (default 1), reporting each stage's speedup over the last --jobs 1 run on this machine")
+    parser.add_argument('--stage-reference', dest='stage_reference_path', metavar='FILE', default=DEFAULT_STAGE_REFERENCE, help="Where --jobs 1 runs keep their stage times for the speedup (default %(default)s)")
+    parser.add_argument('--auto-artifacts', action='store_true', help="Propose an artifact mask by peak-to-peak, flatline and gradient checks if there isn't one yet")
+    if averaging:
+        parser.add_argument('--bands', metavar='HZ-HZ,...', action='store', help="Sweep several bands, e.g. 1-35,0.5-40, saving band-tagged averages from one load (no epoch plots)")
+        parser.add_argument('--band-threads', metavar='N', type=int, default=1, help="Filter swept bands in N threads (default 1)")
+        parser.add_argument('--all-references', action='store_true', help="Load once and save averages for both, O1 only and O2 only references (skips any view)")
+        parser.add_argument('--stream-average', action='store_true', help="Average straight from the continuous data without keeping every epoch in memory (no epoch plots)")
+        if abr:
+            parser.add_argument('--epoch-local-filter', action='store_true', help="Only bandpass the ABR data around each click, same epochs for less filtering when clicks are sparse enough (falls back to the whole recording otherwise)")
+
+
+def processing_options(options=None, **overrides):
+    """
+    BDFWithMetadata settings from parsed arguments (or a dict), with
+    overrides on top. Anything not given is left at its default. Parsed
+    arguments have the script's own flags too, those are ignored, but a
+    dict key that isn't a setting is most likely a typo and gets a warning.
+    """
+    if options is None:
+        options = {}
+    elif isinstance(options, argparse.Namespace):
+        options = vars(options)
+    elif isinstance(options, dict):
+        for key in sorted(set(options) - set(PROCESSING_DEFAULTS)):
+            logging.warning(f"Ignoring unknown processing option {key}")
+    else:
+        # Most likely the old BDFWithMetadata(path, kind, force) call
+        raise TypeError(f"Processing options should be parsed arguments or a dict, not {type(options).__name__} (pass force=True as a keyword)")
+    unknown = set(overrides) - set(PROCESSING_DEFAULTS)
+    if unknown:
+        raise TypeError(f"Unknown processing options {', '.join(sorted(unknown))}")
+    settings = {key: options.get(key, default) for key, default in PROCESSING_DEFAULTS.items()}
+    settings.update(overrides)
+    return settings
+
+
+def parse_bands(text):
+    """
+    Parse a list of bands like "1-35,0.5-40" into [(1.0, 35.0), (0.5, 40.0)]
+    """
+    bands = []
+    for band in text.split(','):
+        highpass, lowpass = band.split('-')
+        bands.append((float(highpass), float(lowpass)))
+    return bands
+
+
+def read_manifest(path):
+    # One BDF path per line, blank lines and # comments ignored
+    paths = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(line)
+    return paths
+
+
+def expand_inputs(patterns, manifests):
+    found = []
+    for manifest in manifests:
+        patterns = patterns + read_manifest(manifest)
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern), recursive=True))
+        if len(matches) == 0:
+            logging.warning(f"Nothing matched {pattern}")
+        found += matches
+
+    # Keep manifest order but drop duplicates
+    seen = set()
+    paths = []
+    for p in found:
+        p = os.path.abspath(p)
+        if p not in seen:
+            seen.add(p)
+            paths.append(p)
+    return paths
+
+
+def read_stage_references(path):
+    # {host: {stage: seconds per million channel samples}}
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return yaml.load(file, Loader=yaml.FullLoader) or {}
+
+
+def stage_reference(path, name):
+    return read_stage_references(path).get(socket.gethostname(), {}).get(name)
+
+
+def record_stage_reference(path, name, seconds):
+    try:
+        references = read_stage_references(path)
+        references.setdefault(socket.gethostname(), {})[name] = seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            yaml.dump(references, file)
+        os.replace(tmp_path, path)
+    except (OSError, yaml.YAMLError) as e:
+        # Only costs us the speedup figure
+        logging.warning(f"Could not record the single-job time of {name} in {path}: {e}")
+
+
+class NeedsManualReview(Exception):
+    """
+    Raised instead of prompting for a start and stop time when events could
+    not be located automatically and we're not running interactively.
+    """
+    pass
+
+
+def find_event_blocks(onsets, sfreq, expected_events, expected_duration):
+    """
+    Find every window of expected_events consecutive events whose duration,
+    including the buffer on either side, is within BUFFER_SECONDS*2 of
+    expected_duration.
+
+    Returns the start index of each matching window and its duration in
+    seconds, best fit first.
+    """
+    onsets = np.asarray(onsets)
+    n = len(onsets) - expected_events + 1
+    if n <= 0:
+        return np.empty(0, dtype=int), np.empty(0)
+
+    # Compare every onset against the one expected_events-1 later, all at once
+    durations = (onsets[expected_events-1:] - onsets[:n]) / sfreq + BUFFER_SECONDS * 2
+    misfit = np.abs(durations - expected_duration)
+    starts = np.flatnonzero(misfit < BUFFER_SECONDS * 2)
+    starts = starts[np.argsort(misfit[starts], kind='stable')]
+    return starts, durations[starts]
+
+
 class BDFWithMetadata():
-    def __init__(self, path, kind, force=False, is_2013I=False, no_reference=False, reference_o1=False, reference_o2=False, no_notch=False, no_crop=False):
+    def __init__(self, path, kind, options=None, interactive=True, **overrides):
         self.script_dir = sys.path[0]
         self.kind = kind
-        self.is_2013I = is_2013I
-        self.no_reference = no_reference
+        # Settings from processing_options, options (parsed arguments or a
+        # dict) with overrides on top, kept for making reference variants
+        self.options = processing_options(options, **overrides)
+        self.force = self.options['force']
+        self.is_2013I = self.options['is_2013I']
+        self.no_reference = self.options['no_reference']
         # Both is the default, so set them to false
+        reference_o1 = self.options['reference_o1']
+        reference_o2 = self.options['reference_o2']
         if reference_o1 and reference_o2:
             reference_o1 = False
             reference_o2 = False
         self.reference_o1 = reference_o1
         self.reference_o2 = reference_o2
-        self.no_notch = no_notch
-        self.no_crop = no_crop
+        self.no_notch = self.options['no_notch']
+        self.no_crop = self.options['no_crop']
+        # When not interactive (batch runs), never block on input()
+        self.interactive = interactive
+        # Decode only the channels and samples we use straight from the BDF
+        self.fast_read = self.options['fast_read']
+        # Pick the block that best fits the expected duration rather than the earliest one
+        self.best_fit_block = self.options['best_fit_block']
+        # Triggers shorter than this many samples are dropped as glitches
+        self.min_trigger_samples = self.options['min_trigger_samples']
+        self.dropped_events = None
+        # Pick the MMN tone sequence from event timing when it's clear enough
+        self.match_tones = self.options['match_tones']
+        self.tone_sequence = None
+        self.tone_match_score = None
+        # Which of self.events had an oddball double click, set by locate_events
+        self.oddball_marks = None
+        # Optional on-disk cache of the preprocessed (and bandpassed) data
+        self.cache = None
+        # Whether the crop came from saved metadata, only then are cache keys
+        # (made from the rounded saved crop) found again by the next run
+        self.crop_saved = False
+        if self.options['cache_dir']:
+            self.cache = eeg_cache.PreprocessedCache(self.options['cache_dir'], self.options['cache_size_gb'])
+        # Optional local copies of the BDFs, read instead of the network share
+        self.staging = None
+        if self.options['staging_dir']:
+            self.staging = eeg_cache.StagingCache(self.options['staging_dir'], self.options['staging_size_gb'])
+        self.staged_path = None
+        # Whether the BDF was already staged, None when not staging or not read
+        self.staging_hit = None
+        # Leave the data unreferenced and derive every reference from it afterwards
+        self.all_references = self.options['all_references']
+        self.epochs = None
+        # Average straight from the continuous data instead of building Epochs,
+        # filling self.averages (or self.band_averages) instead of self.epochs
+        self.stream_average = self.options['stream_average']
+        self.averages = None
+        # Averages for each (highpass, lowpass) when sweeping several bands
+        self.band_averages = None
+        # Epochs per condition and how many overlapped bad annotations
+        self.rejection_counts = None
+        # Propose an artifact mask automatically when there isn't one yet
+        self.auto_artifacts = self.options['auto_artifacts']
+        # Only filter the data around each event, leaving the rest unfiltered
+        self.epoch_local_filter = self.options['epoch_local_filter']
+        # Resample right after cropping so everything after runs on less data.
+        # self.events stays at the recording's own rate, source_sfreq.
+        self.resample_sfreq = self.options['resample_sfreq']
+        self.source_sfreq = None
+        # Leave the notch to build_epochs and do it in the same pass as the bandpass
+        self.fused_filter = self.options['fused_filter']
+        # Threads for filtering and PSD, spread across channels
+        self.jobs = self.options['jobs']
+        # Wall clock seconds of each stage that has run, and for runs with
+        # more than one job the speedup over the single-job reference
+        self.stage_reference_path = self.options['stage_reference_path']
+        self.stage_times = {}
+        self.stage_speedups = {}
 
         # Determine if source path is in the standard /study/thukdam/raw-data/subjects location or not
         p = Path(path).resolve()
@@ -76,7 +373,7 @@ class BDFWithMetadata():
             artifact_path = p
             plot_path = p
             statistics_path = p
-            if not force:
+            if not self.force:
                 # DIE unless they forced to save in current dir with a flag
                 logging.critical("Data file not stored in expected raw-data/subjects directory, please run with --force to save masks and plots and stuff to current directory")
                 sys.exit(1)
@@ -85,6 +382,8 @@ class BDFWithMetadata():
         self.artifact_path = str(artifact_path)
         self.plot_path = str(plot_path)
         self.statistics_path = str(statistics_path)
+        # Every saved average is recorded in a catalog for the group scripts
+        self.catalog = evoked_catalog.EvokedCatalog(self.options['catalog_path'])
 
         logging.info(f"Saving artifacts to {self.artifact_path}")
         logging.info(f"Saving plots to {self.plot_path}")
@@ -112,11 +411,15 @@ class BDFWithMetadata():
                 "Unknown": UNKNOWN,
             }
 
-    def is_standard_frequencies(self):
+    def is_standard_frequencies(self, highpass=None, lowpass=None):
+        if highpass is None:
+            highpass = self.highpass
+        if lowpass is None:
+            lowpass = self.lowpass
         if self.is_mmn():
-            return self.highpass == HIGHPASS_MMN and self.lowpass == LOWPASS_MMN
+            return highpass == HIGHPASS_MMN and lowpass == LOWPASS_MMN
         else:
-            return self.highpass == HIGHPASS_ABR and self.lowpass == LOWPASS_ABR
+            return highpass == HIGHPASS_ABR and lowpass == LOWPASS_ABR
         
 
     def is_mmn(self):
@@ -176,30 +479,42 @@ class BDFWithMetadata():
         expected_duration: Duration in seconds that we want to find them in
         kind: User-visible sort of events we're looking for
         """
-        sfreq = self.raw.info['sfreq']
-        raw_events = mne.find_events(self.raw)
+        sfreq, raw_events = self.find_raw_events()
 
-        skipped_events = 0
-        looking = True
+        marks = None
+        if self.is_mmn():
+            # dpdb02 sequences follow each oddball with a second click, fold
+            # those into their tones so there is one event per tone
+            keep, marks = tone_sequences.fold_double_clicks(raw_events[:,0], sfreq)
+            if not keep.all():
+                logging.info(f"Folded {np.sum(~keep)} oddball double clicks into the tones they mark")
+                raw_events = raw_events[keep]
 
         logging.info(f"Found {len(raw_events)} total events in file.")
         if len(raw_events) < expected_events:
             logging.fatal(f"Not enough events to find {expected_events}, exiting!")
             sys.exit(1)
-        while looking and len(raw_events) - skipped_events >= expected_events:
+
+        starts, durations = find_event_blocks(raw_events[:,0], sfreq, expected_events, expected_duration)
+        self.event_blocks = starts
+        looking = len(starts) == 0
+        if looking:
+            skipped_events = len(raw_events) - expected_events + 1
+        else:
+            # By default take the earliest matching window, same as scanning one event
+            # at a time did, so crops stay reproducible. All of them are kept ranked by fit
+            first = 0 if self.best_fit_block else np.argmin(starts)
+            skipped_events = starts[first]
             tstart = (raw_events[skipped_events,0] - (sfreq * BUFFER_SECONDS))
             self.tstart_seconds = tstart / sfreq
             tstop = (raw_events[skipped_events+expected_events-1,0] + (sfreq * BUFFER_SECONDS))
             self.tstop_seconds = tstop / sfreq
-            duration_seconds = self.tstop_seconds - self.tstart_seconds
+            logging.info(f"Found events at {tstart} with duration {durations[first]} after skipping {skipped_events}")
+            if len(starts) > 1:
+                logging.info(f"{len(starts)} windows fit, best fit skips {starts[0]} with duration {durations[0]}")
 
-            if duration_seconds > expected_duration - BUFFER_SECONDS*2 and \
-                duration_seconds < expected_duration + BUFFER_SECONDS*2:
-                logging.info(f"Found events at {tstart} with duration {duration_seconds} after skipping {skipped_events}")
-                looking = False
-            else:
-                logging.debug(f"Skipped {skipped_events}, at {tstart} with {duration_seconds} (looking for {expected_events})")
-                skipped_events += 1
+        if looking and not self.interactive:
+            raise NeedsManualReview(f"Could not find {expected_events} {kind} events automatically in {self.source_path}, skipped {skipped_events} while trying")
 
         if looking:
             # Sorry if this sucks in actual use, bit of a rush to get this all working
@@ -207,12 +522,18 @@ class BDFWithMetadata():
             logging.warning(f"Please scroll and find start and stop time in seconds manually!")
             # Temporarily set our events to the full list for plotting
             self.events = raw_events.copy()
+            if self.raw is None:
+                self.raw = self.read_raw(self.source_path)
             self.plot(False)
             self.tstart_seconds = float(input(f"Enter {kind} start time (in seconds): "))
             self.tstop_seconds = float(input(f"Enter {kind} stop time (in seconds): "))
 
         # Crop to those seconds
-        self.raw.crop(tmin=self.tstart_seconds, tmax=self.tstop_seconds)
+        if self.raw is None:
+            # Two pass read, only now touch the EEG channels and only in the window
+            self.raw = self.read_raw(self.source_path, self.tstart_seconds, self.tstop_seconds)
+        else:
+            self.raw.crop(tmin=self.tstart_seconds, tmax=self.tstop_seconds)
         self.tstart = self.tstart_seconds * sfreq
         self.tstop = self.tstop_seconds * sfreq
 
@@ -220,11 +541,47 @@ class BDFWithMetadata():
         # keeping in mind we have to start at the index after the start
         index = np.searchsorted(raw_events[:,0], self.tstart)
         self.events = raw_events[index:index+expected_events].copy()
+        if marks is not None:
+            self.oddball_marks = marks[index:index+expected_events]
+
+    def find_raw_events(self):
+        if self.raw is None:
+            # First pass of a fast read, only the Status channel is decoded
+            header = bdf_reader.read_header(self.staged(self.source_path))
+            sfreq, status = bdf_reader.read_status(header)
+            first_samp = 0
+        else:
+            sfreq = self.raw.info['sfreq']
+            status = self.raw.get_data(picks=[bdf_reader.STATUS_CHANNEL])[0]
+            first_samp = self.raw.first_samp
+
+        events, self.dropped_events = bdf_reader.find_events(status, first_samp,
+                min_samples=self.min_trigger_samples)
+        if self.dropped_events:
+            logging.warning(f"Dropped {self.dropped_events} triggers shorter than {self.min_trigger_samples} samples from {self.source_path}")
+        return sfreq, events
+
+    def staged(self, path):
+        # Where to actually read the BDF from, outputs still go by source_path
+        if self.staging is None:
+            return path
+        if self.staged_path is None:
+            self.staged_path, self.staging_hit = self.staging.stage(path)
+        return self.staged_path
+
+    def read_raw(self, raw_file, tmin=None, tmax=None):
+        raw_file = self.staged(raw_file)
+        if self.fast_read:
+            # Only the six EXG electrodes and Status, only inside the crop
+            return bdf_reader.read_raw_subset(raw_file, tmin=tmin, tmax=tmax)
+
+        raw = mne.io.read_raw_bdf(raw_file)
+        if tmin is not None:
+            raw.crop(tmin=tmin, tmax=tmax)
+        return raw
 
     def load_file(self, raw_file):
-        self.raw = mne.io.read_raw_bdf(raw_file)
-
-        # TODO: Original script does weird event deletion, with this comment:
+        # Original script does weird event deletion, with this comment:
         """
         On the South computer, it appears that there are many short (2 or 3
         sample duration) events that are probably due to a problem in the MMN
@@ -233,14 +590,31 @@ class BDFWithMetadata():
         the cause, they're bogus and they screw up analysis. So we'll just delete
         them.
         """
+        # Pass min_trigger_samples (--min-trigger-samples) to do the same here,
+        # it is applied while events are pulled out of the Status channel.
 
         first_run = True
         
         if self.tstart_seconds and len(self.events) > 0:
-            # If we already have information, use that
-            self.raw.crop(tmin=self.tstart_seconds, tmax=self.tstop_seconds)
             first_run = False
-        elif not self.no_crop:
+            self.crop_saved = True
+            # Skip straight past the preprocessing if we've done it before
+            self.raw = self.load_cached("preprocessed")
+            if self.raw is not None:
+                if self.resample_sfreq:
+                    self.source_sfreq = self.recording_sfreq(raw_file)
+                self.load_annotations()
+                return
+            # If we already have information, use that
+            self.raw = self.read_raw(raw_file, self.tstart_seconds, self.tstop_seconds)
+        elif self.fast_read and not self.no_crop:
+            # Events are found from the Status channel alone, then
+            # locate_events reads just the cropped window
+            self.raw = None
+        else:
+            self.raw = self.read_raw(raw_file)
+
+        if first_run and not self.no_crop:
             if self.is_mmn():
                 # Crop to the MMN section of the file
                 self.locate_events(2000, 1000, self.kind)
@@ -262,18 +636,16 @@ class BDFWithMetadata():
         else:
             self.raw.rename_channels({'EXG1': 'Cz', 'EXG2': 'O1', 'EXG3': 'O2', 'EXG4': 'Fz', 'EXG5': 'Pz', 'EXG6': 'T8'})
 
-        # Reference electrodes on mastoids
-        if self.no_reference:
-            logging.warning("Not referencing mastoids, raw view")
+        if self.all_references:
+            logging.info("Leaving data unreferenced, references are applied to each variant")
         else:
-            if self.reference_o1:
-                logging.warning("Referencing only O1")
-                self.raw.set_eeg_reference(['O1'])
-            elif self.reference_o2:
-                logging.warning("Referencing only O2")
-                self.raw.set_eeg_reference(['O2'])
-            else:
-                self.raw.set_eeg_reference(['O1', 'O2'])
+            self.apply_reference()
+
+        if self.resample_sfreq:
+            # Notch, bandpass, epochs and PSD all run on the resampled data from here
+            self.source_sfreq = self.raw.info['sfreq']
+            with self.stage("Resampling"):
+                self.raw = eeg_filters.resample_raw(self.raw, self.resample_sfreq, jobs=self.jobs)
 
         # Try to hack in some electrode location information into the raw.info
         montage = mne.channels.make_standard_montage('biosemi16')
@@ -282,9 +654,12 @@ class BDFWithMetadata():
         # Notch out the India power frequency unless told not to
         if self.no_notch:
             logging.info("Not notch filtering at 50Hz")
+        elif self.fused_filter:
+            logging.info("Notch filtering at 50Hz together with the bandpass when epoching")
         else:
             logging.info("Notch filtering at 50Hz")
-            self.raw.notch_filter(np.arange(50, 251, 50))
+            with self.stage("Notch filter"):
+                self.raw.notch_filter(self.notch_freqs(), n_jobs=self.jobs)
         
         if self.no_crop:
             logging.warning("Not cropping, so not doing any artifact or event loading")
@@ -298,10 +673,164 @@ class BDFWithMetadata():
             # Now we automatically save out the cropping and events metadata
             self.save_metadata()
             self.save_events()
+        else:
+            # Crop came from saved metadata, so the next run can reuse this
+            self.save_cached("preprocessed")
 
         # If previous annotations exist, read them
         self.load_annotations()
 
+    @contextmanager
+    def stage(self, name, units=1):
+        # Wall clock time, scaled to a million channel samples (times units
+        # for stages doing the same work several times). With one job that
+        # is this machine's reference for the stage, with more it gives the
+        # speedup over it.
+        samples = units * len(self.raw.ch_names) * self.raw.n_times / 1e6
+        # The paradigm's band and the filter flags change the work per sample
+        key = f"{self.kind} {name}"
+        if self.fused_filter:
+            key += " fused"
+        if self.epoch_local_filter:
+            key += " epoch-local"
+        start = time.time()
+        if self.jobs > 1 and parallel_backend is not None:
+            # Threads share the data instead of pickling it to worker processes
+            backend = parallel_backend('threading', n_jobs=self.jobs)
+        else:
+            backend = nullcontext()
+        with backend:
+            yield
+        wall = time.time() - start
+        self.stage_times[name] = wall
+        if self.jobs == 1:
+            record_stage_reference(self.stage_reference_path, key, float(wall / samples))
+            logging.info(f"{name} took {wall:.2f}s with 1 job")
+            return
+        reference = stage_reference(self.stage_reference_path, key)
+        if reference is None or wall <= 0:
+            logging.info(f"{name} took {wall:.2f}s with {self.jobs} jobs, run once with --jobs 1 for its speedup")
+            return
+        single = reference * samples
+        self.stage_speedups[name] = single / wall
+        logging.info(f"{name} took {wall:.2f}s with {self.jobs} jobs, {single / wall:.1f}x speedup over {single:.2f}s with 1 job")
+
+    def notch_freqs(self):
+        # Harmonics past Nyquist are already gone if we resampled
+        freqs = np.arange(50, 251, 50)
+        return freqs[freqs < self.raw.info['sfreq'] / 2]
+
+    def recording_sfreq(self, raw_file):
+        # Only the header, for when the data itself came from the cache
+        header = bdf_reader.read_header(raw_file)
+        return bdf_reader.sampling_rate(header, bdf_reader.channel_index(header, bdf_reader.STATUS_CHANNEL))
+
+    def events_sfreq(self):
+        # Sampling rate self.events is in, same as the saved events file
+        return self.source_sfreq or self.raw.info['sfreq']
+
+    def epoch_events(self):
+        # self.events moved onto the (possibly resampled) data
+        sfreq = self.raw.info['sfreq']
+        if sfreq == self.events_sfreq() or len(self.events) == 0:
+            return self.events
+        events = np.array(self.events, copy=True)
+        events[:, 0] = np.round(events[:, 0] * sfreq / self.events_sfreq())
+        return events
+
+    def apply_reference(self):
+        # Reference electrodes on mastoids
+        if self.no_reference:
+            logging.warning("Not referencing mastoids, raw view")
+        else:
+            if self.reference_o1:
+                logging.warning("Referencing only O1")
+                self.raw.set_eeg_reference(['O1'])
+            elif self.reference_o2:
+                logging.warning("Referencing only O2")
+                self.raw.set_eeg_reference(['O2'])
+            else:
+                self.raw.set_eeg_reference(['O1', 'O2'])
+
+    def save_reference_averages(self, bands=None, threads=1):
+        """
+        Save averages for each mastoid reference (both, O1 only and O2 only)
+        from one unreferenced load, each to its own usual artifact, plot and
+        statistics paths.
+
+        Variants are filtered, averaged and saved one at a time, and each one
+        is let go before the next is copied, so no more than one referenced
+        copy of the data is held next to self.raw. The last variant takes
+        self.raw over instead of copying it, so self.raw is gone afterwards.
+
+        Referencing and notch filtering are both linear, so doing the notch
+        once before referencing gives the same data as separate runs.
+        """
+        for i, (reference_o1, reference_o2) in enumerate(REFERENCE_VARIANTS):
+            # The data is referenced here rather than at load time
+            variant = BDFWithMetadata(self.source_path, self.kind, self.options,
+                    interactive=self.interactive,
+                    no_reference=False,
+                    reference_o1=reference_o1,
+                    reference_o2=reference_o2,
+                    all_references=False)
+            variant.cache = self.cache
+            variant.staging = self.staging
+            variant.source_sfreq = self.source_sfreq
+            variant.tstart_seconds = self.tstart_seconds
+            variant.tstop_seconds = self.tstop_seconds
+            variant.crop_saved = self.crop_saved
+            variant.events = self.events
+            variant.highpass = self.highpass
+            variant.lowpass = self.lowpass
+            if i == len(REFERENCE_VARIANTS) - 1:
+                # Nothing needs the unreferenced data after this one
+                variant.raw = self.raw
+                self.raw = None
+            else:
+                variant.raw = self.raw.copy()
+            variant.apply_reference()
+            variant.load_annotations()
+            variant.build_epochs(bands=bands, threads=threads)
+            if variant.is_mmn():
+                variant.decimate_epochs()
+            variant.save_average()
+            # Free this variant's data before copying the next
+            variant = None
+
+    def cache_params(self, stage):
+        # Everything that changes the cached data for this stage
+        params = {
+            'stage': stage,
+            'tstart_seconds': self.tstart_seconds,
+            'tstop_seconds': self.tstop_seconds,
+            'no_reference': self.no_reference,
+            'all_references': self.all_references,
+            'reference_o1': self.reference_o1,
+            'reference_o2': self.reference_o2,
+            'no_notch': self.no_notch,
+            'fast_read': self.fast_read,
+            'resample_sfreq': self.resample_sfreq,
+            'fused_filter': self.fused_filter,
+        }
+        if stage == "filtered":
+            params['highpass'] = self.highpass
+            params['lowpass'] = self.lowpass
+            params['epoch_local_filter'] = self.epoch_local_filter
+        return params
+
+    def load_cached(self, stage):
+        if self.cache is None:
+            return None
+        return self.cache.load(self.cache.key(self.source_path, self.cache_params(stage)))
+
+    def save_cached(self, stage):
+        if self.cache is None:
+            return
+        params = self.cache_params(stage)
+        self.cache.save(self.cache.key(self.source_path, params), self.raw,
+                description=dict(params, source_path=self.source_path))
+
 
     def save_metadata(self):
         data = {
@@ -312,6 +841,13 @@ class BDFWithMetadata():
             'highpass': self.highpass,
             'lowpass': self.lowpass,
         }
+        if self.min_trigger_samples:
+            data['min_trigger_samples'] = self.min_trigger_samples
+            data['dropped_events'] = self.dropped_events
+        if self.tone_sequence:
+            data['tone_sequence'] = self.tone_sequence
+        if self.tone_match_score is not None:
+            data['tone_match_score'] = self.tone_match_score
         with open(self.artifact_metadata_file(), 'w') as file:
             yaml.dump(data, file)
 
@@ -319,6 +855,9 @@ class BDFWithMetadata():
         np.save(self.events_file(), self.events)
 
     def load_annotations(self):
+        if self.auto_artifacts:
+            self.propose_artifacts()
+
         mask_path = self.artifact_mask_file()
 
         # If we can't find the file at the default path, try stripping out -o1 or -o2
@@ -327,11 +866,34 @@ class BDFWithMetadata():
             mask_path = self.strip_reference_electrode(mask_path)
 
         if os.path.exists(mask_path):
+            # MNE can't read back a mask with no annotations in it (older
+            # proposals saved them as just the CSV header)
+            with open(mask_path) as file:
+                empty = len(file.read().split()) <= 1
+            if empty:
+                logging.warning(f"Artifact annotations in {mask_path} are empty, ignoring them")
+                return
             logging.info(f"Loading existing artifact annotations from {mask_path}")
             a = mne.read_annotations(mask_path)
             self.raw.set_annotations(a)
 
 
+    def propose_artifacts(self):
+        # Never replace a mask somebody already made or checked
+        mask_path = self.artifact_mask_file()
+        if os.path.exists(mask_path) or os.path.exists(self.strip_reference_electrode(mask_path)):
+            logging.info("Artifact mask already exists, not detecting artifacts")
+            return
+
+        logging.info("Detecting artifacts automatically, check them in the view")
+        annotations = artifact_detection.detect(self.raw, EPOCH_CHANNELS)
+        if len(annotations) == 0:
+            # Nothing to check, and an empty mask can't be read back
+            logging.info("No artifacts detected, not saving a mask")
+            return
+        annotations.save(mask_path)
+        logging.info(f"Saved {len(annotations)} proposed artifact annotations to {mask_path}")
+
     def load_event_tones_for_mmn(self):
         logging.info(f"Determining MMN event types")
         # Now we need to load the right event tones and paste them into the event array
@@ -356,7 +918,12 @@ class BDFWithMetadata():
 
         # NOTE: This code matches what the original Matlab script does,
         # but note that we're assuming UTC which feels... strange.
-        meas_date = self.raw.info['meas_date'][0]
+        meas_date = self.raw.info['meas_date']
+        if isinstance(meas_date, datetime):
+            # Newer MNE gives a datetime instead of (seconds, microseconds)
+            meas_date = int(meas_date.timestamp())
+        else:
+            meas_date = meas_date[0]
         logging.info(f'Measured date string in BDF file is {meas_date}')
         recordedDate = datetime.fromtimestamp(meas_date, pytz.timezone("UTC"))
 
@@ -366,8 +933,7 @@ class BDFWithMetadata():
 
         logging.info(f'Script start day of year = {doy}')
         noon = actualStart.replace(hour=12, minute=0, second=0)
-        if abs(noon - actualStart).seconds < 600:
-            logging.warning(f"WARNING: start time {actualStart} is close to noon, so the event tone discovery may be wrong")
+        closeToNoon = abs(noon - actualStart).seconds < 600
 
         # We can now guess which tone sequence .TXT file to use for assigning
         # tone IDs to events in the .BDF file.
@@ -381,24 +947,39 @@ class BDFWithMetadata():
         dayEven = doy % 2
         whichSeq = 2 * dayEven + daySegment
         mmnToneFileName = f"{mmnToneFileStart}{whichSeq}{mmnToneFileEnd}"
+
+        matched = None
+        if self.match_tones:
+            # Score the oddball double clicks against every sequence, north and south
+            marks = self.oddball_marks
+            if marks is None:
+                marks = np.zeros(len(self.events), dtype=bool)
+            matched = tone_sequences.match(marks, mmnToneDir, preferred=mmnToneFileName)
+            if matched:
+                path, score, margin = matched
+                self.tone_match_score = score
+                if score >= tone_sequences.MIN_MATCH_SCORE and margin >= tone_sequences.MIN_MATCH_MARGIN:
+                    if os.path.abspath(path) != os.path.abspath(mmnToneFileName):
+                        logging.warning(f"Event timing matches {path}, not {mmnToneFileName} from the day of year, using the timing match")
+                    mmnToneFileName = path
+                else:
+                    logging.warning(f"Tone sequence match is not confident (score {score:.3f}, margin {margin:.3f}), using day of year")
+                    matched = None
+
+        if closeToNoon and not matched:
+            logging.warning(f"WARNING: start time {actualStart} is close to noon, so the event tone discovery may be wrong")
+
+        self.tone_sequence = os.path.relpath(mmnToneFileName, mmnToneDir)
         logging.info(f"Loading tones from {mmnToneFileName}")
 
-        with open(mmnToneFileName) as csvfile:
-            reader = csv.reader(csvfile)
-            tones = next(reader)
-            # NOTE: there are way more than 2000 entries because of... legacy reasons. IGNORE
+        tones, deviant = tone_sequences.lookup(mmnToneDir, mmnToneFileName)
 
         # Finally, we know enough to repair the events in the raw data
-        # and mark them same or deviant
-        numSameEvents = 0
-        numDeviantEvents = 0
-        for i in range(1, len(self.events)):
-            if (tones[i] == tones[i - 1]):
-                self.events[i,2] = STANDARD
-                numSameEvents += 1
-            else:
-                self.events[i,2] = DEVIANT
-                numDeviantEvents += 1
+        # and mark them same or deviant, all at once from the precomputed labels
+        is_deviant = deviant[1:len(self.events)]
+        self.events[1:,2] = np.where(is_deviant, DEVIANT, STANDARD)
+        numDeviantEvents = int(np.sum(is_deviant))
+        numSameEvents = len(is_deviant) - numDeviantEvents
         logging.info(f"Determined {numSameEvents} same events and {numDeviantEvents} deviant events")
 
     def artifact_mask_file(self):
@@ -410,9 +991,16 @@ class BDFWithMetadata():
     def events_file(self):
         return self.artifact_path + f".{self.kind}_events.npy"
 
+    def envelope_file(self):
+        return self.artifact_path + f".{self.kind}_envelope.npz"
+
     def plot_output_path(self, name):
         return self.plot_path + f".{self.kind}_{name}.png"
 
+    def envelopes(self):
+        # Min/max envelopes of the channels in the view, built once and saved
+        return envelope_view.load_or_build(self.envelope_file(), self.raw, VIEW_ORDER, self.highpass_artifact)
+
     def plot(self, block=True, display_huge=False, no_events=False):
         if display_huge:
             if self.is_mmn:
@@ -424,14 +1012,22 @@ class BDFWithMetadata():
         else:
             duration = 5.0
             scalings = dict(eeg=50e-6)
-            events = self.events
+            events = self.epoch_events()
 
         if no_events:
             events = None
 
-        order = [1, 2, 3, 0, 4, 5]
+        order = VIEW_ORDER
         n_channels = 7
 
+        if display_huge:
+            # Far too many samples for raw.plot to scroll through, draw
+            # min/max envelopes instead
+            browser = envelope_view.EnvelopeBrowser(self.raw, VIEW_ORDER, self.envelopes(),
+                    self.highpass_artifact, duration, scalings['eeg'])
+            browser.show(block=block)
+            return
+
         self.raw.plot(
             block=block,
             n_channels=n_channels,
@@ -444,7 +1040,10 @@ class BDFWithMetadata():
             scalings=scalings)
 
     def artifact_rejection(self, display_huge=False, no_events=False):
-        logging.info("View loaded. Ready for artifact rejection! Press 'a' to start, add a label, and then drag on the graph. Close the view window to continue.")
+        if display_huge:
+            logging.info("View loaded. Ready for artifact rejection! Arrows scroll, - and + zoom, press 'a' and drag on the graph to mark bad segments, right click one to remove it. Close the view window to continue.")
+        else:
+            logging.info("View loaded. Ready for artifact rejection! Press 'a' to start, add a label, and then drag on the graph. Close the view window to continue.")
         self.plot(display_huge=display_huge, no_events=no_events)
 
         mask_path = self.artifact_mask_file()
@@ -453,22 +1052,138 @@ class BDFWithMetadata():
         if len(self.raw.annotations) > 0:
             self.raw.annotations.save(mask_path)
 
-    def build_epochs(self):
-        # Actually do the real final filtering (happens in-place)
-        self.raw.filter(l_freq=self.highpass, h_freq=self.lowpass, fir_design='firwin')
+    def build_epochs(self, bands=None, threads=1):
+        """
+        Filter and epoch the data.
 
-        # Epoching...
-        picks = ['Cz', 'Fz', 'Pz', 'T8']
+        bands: Optional list of (highpass, lowpass) to sweep. Each band is
+        filtered from its own copy of the preprocessed data, in up to
+        `threads` threads, and averaged straight away so the copy can go.
+        self.band_averages maps each band to its averages.
+
+        With stream_average, the averages are built instead of epochs, in
+        self.averages (or self.band_averages).
+        """
+        if bands:
+            def filter_band(band):
+                logging.info(f"Filtering band {band[0]}Hz to {band[1]}Hz")
+                raw = self.filter_raw(self.raw.copy(), band[0], band[1])
+                if self.stream_average:
+                    return self.make_averages(raw)
+                return self.average_epochs(self.make_epochs(raw))
+
+            with self.stage("Bandpass sweep", units=len(bands)):
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    self.band_averages = dict(zip(bands, pool.map(filter_band, bands)))
+            return self.band_averages
+
+        cached = self.load_cached("filtered") if self.crop_saved else None
+        if cached is not None:
+            cached.set_annotations(self.raw.annotations)
+            self.raw = cached
+        else:
+            # Actually do the real final filtering (happens in-place)
+            with self.stage("Bandpass filter"):
+                self.filter_raw(self.raw, self.highpass, self.lowpass)
+            if self.crop_saved:
+                self.save_cached("filtered")
+
+        if self.stream_average:
+            self.averages = self.make_averages(self.raw)
+            return self.averages
+
+        self.epochs = self.make_epochs(self.raw)
+        return self.epochs
+
+    def filter_raw(self, raw, highpass, lowpass):
+        kernel = None
+        if self.fused_filter and not self.no_notch:
+            # Kernels are shared through the preprocessed cache directory if there is one
+            kernel_dir = self.cache.cache_dir if self.cache else None
+            kernel = eeg_filters.fused_kernel(raw.info['sfreq'], highpass, lowpass,
+                    self.notch_freqs(), kernel_dir)
+
+        if self.epoch_local_filter:
+            # Epochs only ever see the filtered windows, so skip the rest
+            tmin, tmax = self.epoch_window()
+            return eeg_filters.filter_around_events(raw, self.epoch_events(), tmin, tmax,
+                    highpass, lowpass, picks=EPOCH_CHANNELS, kernel=kernel, jobs=self.jobs)
+        if kernel is not None:
+            return eeg_filters.apply_kernel(raw, kernel, highpass, lowpass, jobs=self.jobs)
+        return raw.filter(l_freq=highpass, h_freq=lowpass, fir_design='firwin', n_jobs=self.jobs)
+
+    def epoch_window(self):
         if self.is_mmn():
-            tmin, tmax = -0.1, 0.4
+            return -0.1, 0.4
         else:
-            tmin, tmax = -0.002, 0.010
+            return -0.002, 0.010
 
-        epochs_params = dict(events=self.events, event_id=self.event_id,
+    def make_epochs(self, raw):
+        # Epoching...
+        picks = EPOCH_CHANNELS
+        tmin, tmax = self.epoch_window()
+
+        # Bad annotations are already taken out of the events, all at once
+        epochs_params = dict(events=self.good_events(raw), event_id=self.event_id,
                             tmin=tmin, tmax=tmax,
-                            picks=picks, reject=None, flat=None)
+                            picks=picks, reject=None, flat=None,
+                            reject_by_annotation=False)
 
-        self.epochs = mne.Epochs(self.raw, **epochs_params)
+        return mne.Epochs(raw, **epochs_params)
+
+    def average_conditions(self):
+        # Output name and the events that go into each saved average
+        if self.is_mmn():
+            return {
+                "deviant": ["Deviant"],
+                "standard": ["Standard"],
+                "all": list(self.event_id),
+            }
+        return {"all": list(self.event_id)}
+
+    def make_averages(self, raw):
+        # Same averages as make_epochs then average_epochs, one epoch buffer per condition
+        tmin, tmax = self.epoch_window()
+        return streaming_average.stream_averages(raw, self.good_events(raw), self.event_id,
+                tmin, tmax, EPOCH_CHANNELS, self.average_conditions())
+
+    def good_events(self, raw):
+        # Events whose epochs don't overlap a bad annotation on raw
+        events = self.epoch_events()
+        tmin, tmax = self.epoch_window()
+        rejected = artifact_mask.reject_events(raw, events, tmin, tmax)
+        self.rejection_counts = artifact_mask.condition_counts(events, rejected,
+                self.event_id, self.average_conditions())
+        return events[~rejected]
+
+    def average_epochs(self, epochs):
+        averages = {}
+        for name, events in self.average_conditions().items():
+            if name == "all":
+                averages[name] = epochs.average()
+            else:
+                averages[name] = epochs[events].average()
+        return averages
+
+    def decimate_epochs(self):
+        # Only decimate if srate is high
+        if self.raw.info['sfreq'] > 16000:
+            # All the data was just reduced by a factor of 3 because that fits in memory better
+            # The manual process reduced down to 512hz, pass resample_sfreq=512
+            # (--resample 512) to do that at load time instead
+            factor = 3
+            logging.info(f"Decimating epochs in memory by a factor of {factor}")
+            if self.band_averages:
+                decimate = [e for averages in self.band_averages.values() for e in averages.values()]
+            elif self.averages:
+                # Picking every third sample of the average is the same as of each epoch
+                decimate = list(self.averages.values())
+            else:
+                decimate = [self.epochs]
+            for inst in decimate:
+                inst.decimate(factor)
+        else:
+            logging.info("File already decimated, not decimating")
         return self.epochs
 
 
@@ -488,25 +1203,48 @@ class BDFWithMetadata():
         self.save_figure(fig, "epochs")
 
 
-    def average_output_path(self, name):
+    def average_output_path(self, name, highpass=None, lowpass=None):
+        if highpass is None:
+            highpass = self.highpass
+        if lowpass is None:
+            lowpass = self.lowpass
+        # Tag non-standard bands like save_figure does, so they don't overwrite the standard averages
+        if not self.is_standard_frequencies(highpass, lowpass):
+            name = f"{name}_{highpass}Hz_to_{lowpass}Hz"
         return self.statistics_path + f".{self.kind}-{name}-ave.fif"
 
-    def save_average(self):
-        if self.is_mmn():
-            deviant = self.epochs["Deviant"].average()
-            dfile = self.average_output_path("deviant")
-            logging.info(f"Saved evoked averages of deviant events to {dfile}")
-            mne.write_evokeds(dfile, deviant)
-
-            standard = self.epochs["Standard"].average()
-            sfile = self.average_output_path("standard")
-            mne.write_evokeds(sfile, standard)
-            logging.info(f"Saved evoked averages of standard events to {sfile}")
+    def rejection_counts_file(self):
+        return self.statistics_path + f".{self.kind}_rejection_counts.yaml"
 
-        average = self.epochs.average()
-        afile = self.average_output_path("all")
-        mne.write_evokeds(afile, average)
-        logging.info(f"Saved evoked averages to {afile}")
+    def save_average(self):
+        if self.rejection_counts:
+            with open(self.rejection_counts_file(), 'w') as file:
+                yaml.dump(self.rejection_counts, file)
+            logging.info(f"Saved epoch rejection counts to {self.rejection_counts_file()}")
+        if self.band_averages:
+            for (highpass, lowpass), averages in self.band_averages.items():
+                self.save_evokeds(averages, highpass, lowpass)
+        elif self.averages:
+            self.save_evokeds(self.averages, self.highpass, self.lowpass)
+        else:
+            self.save_evokeds(self.average_epochs(self.epochs), self.highpass, self.lowpass)
+
+    def save_evokeds(self, averages, highpass, lowpass):
+        reference = evoked_catalog.reference_name(self.reference_o1, self.reference_o2, self.no_reference)
+        for name, evoked in averages.items():
+            path = self.average_output_path(name, highpass, lowpass)
+            # So rebuilding the catalog from the files gives the same reference
+            evoked_catalog.describe_reference(evoked, reference)
+            mne.write_evokeds(path, evoked)
+            logging.info(f"Saved evoked averages of {name} events to {path}")
+            self.catalog.record(path, evoked,
+                    subject=Path(self.statistics_path).parent.name,
+                    paradigm=self.kind,
+                    condition=name,
+                    reference=reference,
+                    highpass=highpass,
+                    lowpass=lowpass,
+                    standard_band=self.is_standard_frequencies(highpass, lowpass))
 
     def epoch_view(self):
         logging.info("Loading epoch viewer...")
@@ -516,7 +1254,8 @@ class BDFWithMetadata():
         # Spectral density is go!
         # https://mne.tools/stable/generated/mne.io.Raw.html#mne.io.Raw.plot_psd
         #fig = self.raw.plot_psd(0, high_freq, average=False, show=False, estimate='power')
-        fig = self.raw.plot_psd(0, high_freq, area_mode='std', show=False, n_fft=60000)
+        with self.stage("PSD"):
+            fig = self.raw.plot_psd(0, high_freq, area_mode='std', show=False, n_fft=60000, n_jobs=self.jobs)
         title = f"Power spectral density for {self.kind}"
         self.save_figure(fig, f"psd_to_{high_freq}", True)
 
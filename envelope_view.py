@@ -0,0 +1,261 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import mne
+from matplotlib import pyplot as plt
+from matplotlib.widgets import SpanSelector
+
+# Zoomed-out artifact view (--display-huge) drawn from precomputed min/max
+# envelopes, instead of raw.plot pushing every one of the 16 million samples
+# of a 1000s MMN recording through matplotlib on every scroll.
+#
+# Level 0 of the envelope pyramid keeps the min and max of every BASE_BIN
+# samples and each level above combines LEVEL_FACTOR bins of the one below.
+# The view draws from the coarsest level that still has a bin for every
+# pixel, which looks the same as drawing every sample, and only goes back to
+# the samples themselves once zoomed in past level 0.
+#
+# The envelopes are of the data highpassed the way raw.plot(highpass=...)
+# does it, so the overview looks like the normal view. They are saved beside
+# the artifact metadata and rebuilt when the data they came from changes.
+
+BASE_BIN = 64
+LEVEL_FACTOR = 4
+# Stop adding levels once the coarsest one has fewer bins than this
+MIN_BINS = 1000
+# Data either side of a zoomed in window, so the highpass has settled
+RAW_PAD_SECONDS = 10
+# Every this many samples goes into the check that the data hasn't changed
+FINGERPRINT_STRIDE = 4099
+
+
+def view_filter(data, sfreq, highpass):
+    # Same zero phase 4th order Butterworth raw.plot uses for its highpass
+    if not highpass:
+        return data
+    return mne.filter.filter_data(data, sfreq, highpass, None, method='iir',
+            iir_params=dict(order=4, ftype='butter', output='sos'), verbose=False)
+
+
+def bin_extremes(low, high, factor):
+    # Min of low and max of high over consecutive groups of factor columns,
+    # with the ragged end as one last, shorter group
+    n = low.shape[1]
+    full = n // factor * factor
+    mins = low[:, :full].reshape(len(low), -1, factor).min(axis=2)
+    maxs = high[:, :full].reshape(len(high), -1, factor).max(axis=2)
+    if full < n:
+        mins = np.column_stack([mins, low[:, full:].min(axis=1)])
+        maxs = np.column_stack([maxs, high[:, full:].max(axis=1)])
+    return mins, maxs
+
+
+def describe(raw, picks, highpass):
+    # Everything an envelope depends on, to tell whether a saved one is stale.
+    # A strided sample of the data catches a different reference or notch.
+    data = np.ascontiguousarray(raw._data[picks, ::FINGERPRINT_STRIDE])
+    return {
+        'sfreq': float(raw.info['sfreq']),
+        'n_times': int(raw.n_times),
+        'highpass': float(highpass or 0),
+        'ch_names': [raw.ch_names[p] for p in picks],
+        'fingerprint': hashlib.sha1(data.tobytes()).hexdigest(),
+    }
+
+
+def build(raw, picks, highpass):
+    """
+    Min/max envelope pyramid of the picked channels of raw, as a dict of bin
+    size in samples to (mins, maxs) arrays of shape (channels, bins).
+    """
+    sfreq = raw.info['sfreq']
+    logging.info(f"Building min/max envelopes of {len(picks)} channels")
+    # A channel at a time, so there's only ever one filtered copy
+    channels = []
+    for pick in picks:
+        x = view_filter(raw._data[pick:pick + 1], sfreq, highpass)
+        mins, maxs = bin_extremes(x, x, BASE_BIN)
+        channel = [(mins, maxs)]
+        while mins.shape[1] > MIN_BINS:
+            mins, maxs = bin_extremes(mins, maxs, LEVEL_FACTOR)
+            channel.append((mins, maxs))
+        channels.append(channel)
+
+    levels = {}
+    for i in range(len(channels[0])):
+        levels[BASE_BIN * LEVEL_FACTOR ** i] = (
+                np.concatenate([c[i][0] for c in channels]).astype(np.float32),
+                np.concatenate([c[i][1] for c in channels]).astype(np.float32))
+    return levels
+
+
+def save(path, levels, description):
+    arrays = {}
+    for bin_size, (mins, maxs) in levels.items():
+        arrays[f"min_{bin_size}"] = mins
+        arrays[f"max_{bin_size}"] = maxs
+    for name, value in description.items():
+        arrays[f"describe_{name}"] = np.array(value)
+    try:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, path)
+        logging.info(f"Saved envelopes to {path}")
+    except OSError as e:
+        logging.warning(f"Could not save envelopes to {path}: {e}")
+
+
+def load(path, description):
+    # The saved levels, or None if they are missing or from different data
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        for name, value in description.items():
+            key = f"describe_{name}"
+            if key not in saved or saved[key].tolist() != value:
+                logging.info(f"Envelopes in {path} are out of date")
+                return None
+        sizes = sorted(int(k[len("min_"):]) for k in saved.files if k.startswith("min_"))
+        return {b: (saved[f"min_{b}"], saved[f"max_{b}"]) for b in sizes}
+
+
+def load_or_build(path, raw, picks, highpass):
+    description = describe(raw, picks, highpass)
+    levels = load(path, description)
+    if levels is None:
+        levels = build(raw, picks, highpass)
+        save(path, levels, description)
+    else:
+        logging.info(f"Loaded envelopes from {path}")
+    return levels
+
+
+class EnvelopeBrowser:
+    """
+    Scrolling view of the picked channels of raw drawn from envelope levels.
+
+    Left and right arrows scroll by a quarter of the window (shift for a
+    whole window), - and + zoom out and in, and 'a' toggles dragging out
+    new BAD_ annotations. Right click an annotation to remove it.
+    """
+
+    def __init__(self, raw, picks, levels, highpass, duration, scaling):
+        self.raw = raw
+        self.picks = picks
+        self.levels = levels
+        self.highpass = highpass
+        self.sfreq = raw.info['sfreq']
+        self.length = raw.n_times / self.sfreq
+        self.duration = min(duration, self.length)
+        self.start = 0.0
+        # raw.plot puts one scaling either side of each channel
+        self.spacing = 2 * scaling
+        self.annotating = False
+
+        self.fig, self.ax = plt.subplots(figsize=(14, 8))
+        self.selector = SpanSelector(self.ax, self.on_select, 'horizontal', useblit=True)
+        self.selector.set_active(False)
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key)
+        self.fig.canvas.mpl_connect('button_press_event', self.on_click)
+        self.draw()
+
+    def window_traces(self):
+        # Times and low and high edges of each channel across the window,
+        # low and high are the same array when drawing samples
+        start = int(self.start * self.sfreq)
+        stop = min(start + int(round(self.duration * self.sfreq)), self.raw.n_times)
+        per_pixel = (stop - start) / max(self.ax.bbox.width, 1)
+        fitting = [b for b in self.levels if b <= per_pixel]
+        if not fitting:
+            pad = int(RAW_PAD_SECONDS * self.sfreq)
+            lo, hi = max(start - pad, 0), min(stop + pad, self.raw.n_times)
+            x = view_filter(self.raw._data[self.picks, lo:hi], self.sfreq, self.highpass)
+            x = x[:, start - lo:stop - lo]
+            return np.arange(start, stop) / self.sfreq, x, x, "samples"
+
+        bin_size = max(fitting)
+        mins, maxs = self.levels[bin_size]
+        first, last = start // bin_size, -(-stop // bin_size)
+        times = np.arange(first, last) * bin_size / self.sfreq
+        return times, mins[:, first:last], maxs[:, first:last], f"envelope of {bin_size} samples"
+
+    def draw(self):
+        ax = self.ax
+        ax.clear()
+        times, low, high, source = self.window_traces()
+        n = len(self.picks)
+        offsets = (n - 1 - np.arange(n)) * self.spacing
+        # Like remove_dc=True, centre each channel on its mean over the window
+        dc = np.mean((low + high) / 2, axis=1)
+        for i in range(n):
+            if low is high:
+                ax.plot(times, low[i] - dc[i] + offsets[i], color='k', linewidth=0.5)
+            else:
+                ax.fill_between(times, low[i] - dc[i] + offsets[i], high[i] - dc[i] + offsets[i],
+                        color='k', linewidth=0.5)
+
+        end = self.start + self.duration
+        first_time = self.raw.first_time
+        for onset, duration, description in zip(self.raw.annotations.onset,
+                self.raw.annotations.duration, self.raw.annotations.description):
+            onset -= first_time
+            if onset < end and onset + duration > self.start:
+                color = 'red' if description.lower().startswith('bad') else 'grey'
+                ax.axvspan(onset, onset + duration, color=color, alpha=0.3)
+
+        ax.set_xlim(self.start, end)
+        ax.set_ylim(-self.spacing, n * self.spacing)
+        ax.set_yticks(offsets)
+        ax.set_yticklabels([self.raw.ch_names[p] for p in self.picks])
+        ax.set_xlabel("Time (s)")
+        mode = ", annotating" if self.annotating else ""
+        ax.set_title(f"{self.start:.1f}s to {end:.1f}s of {self.length:.1f}s ({source}{mode})")
+        self.fig.canvas.draw_idle()
+
+    def scroll(self, seconds):
+        self.start = float(np.clip(self.start + seconds, 0, max(self.length - self.duration, 0)))
+        self.draw()
+
+    def zoom(self, factor):
+        middle = self.start + self.duration / 2
+        self.duration = float(np.clip(self.duration * factor, 10 / self.sfreq, self.length))
+        self.start = middle - self.duration / 2
+        self.scroll(0)
+
+    def on_key(self, event):
+        if event.key == 'right':
+            self.scroll(self.duration / 4)
+        elif event.key == 'left':
+            self.scroll(-self.duration / 4)
+        elif event.key == 'shift+right':
+            self.scroll(self.duration)
+        elif event.key == 'shift+left':
+            self.scroll(-self.duration)
+        elif event.key == '-':
+            self.zoom(2)
+        elif event.key in ('+', '='):
+            self.zoom(0.5)
+        elif event.key == 'a':
+            self.annotating = not self.annotating
+            self.selector.set_active(self.annotating)
+            self.draw()
+
+    def on_select(self, tmin, tmax):
+        if tmax > tmin:
+            self.raw.annotations.append(tmin + self.raw.first_time, tmax - tmin, "BAD_")
+            self.draw()
+
+    def on_click(self, event):
+        # Right click removes the annotations under the pointer
+        if event.button != 3 or event.inaxes is not self.ax:
+            return
+        onsets = self.raw.annotations.onset - self.raw.first_time
+        hit = np.flatnonzero((onsets <= event.xdata) & (onsets + self.raw.annotations.duration >= event.xdata))
+        if len(hit) > 0:
+            self.raw.annotations.delete(hit)
+            self.draw()
+
+    def show(self, block=True):
+        plt.show(block=block)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+from pathlib import Path
+import logging
+import coloredlogs
+import mne
+
+# SQLite index of every saved -ave.fif, so the group scripts can look up a
+# subject's averages with one indexed query instead of globbing the network
+# share for each subject and condition.
+#
+# save_average records each file as it is written. Files saved before the
+# catalog existed (or on another machine) can be added by running this script
+# on the statistics directory, which walks it once:
+#
+#     evoked_catalog.py /study/thukdam/analyses/eeg_statistics
+#
+# The catalog lives on local disk by default, SQLite's locking can't be
+# trusted on the NFS share. Lookups open it read only.
+#
+# When a subject has more than one recording with every condition asked for,
+# the most recently saved one is used for all of them, the same one every time.
+
+CATALOG_NAME = "evoked_catalog.sqlite"
+DEFAULT_CATALOG = os.path.join("~", ".cache", "thukdam", CATALOG_NAME)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evokeds (
+    path TEXT PRIMARY KEY,
+    subject TEXT,
+    paradigm TEXT,
+    condition TEXT,
+    reference TEXT,
+    highpass REAL,
+    lowpass REAL,
+    standard_band INTEGER,
+    sfreq REAL,
+    nave INTEGER,
+    n_times INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS lookup ON evokeds (paradigm, reference, subject, condition, standard_band, highpass, lowpass);
+"""
+
+# {stem}.{kind}-{condition}[_{highpass}Hz_to_{lowpass}Hz]-ave.fif,
+# see BDFWithMetadata.average_output_path
+AVERAGE_NAME = re.compile(r"\.(mmn|abr)-([a-z]+)(?:_([\d.]+)Hz_to_([\d.]+)Hz)?-ave\.fif$")
+
+
+# save_average notes the reference applied in each average's description.
+# The directory can't tell --no-reference apart from both mastoids, they are
+# saved to the same place.
+REFERENCE_DESCRIPTION = re.compile(r"^reference=(\w+)$")
+
+
+def reference_name(reference_o1, reference_o2, no_reference=False):
+    if no_reference:
+        return "none"
+    if reference_o1 and not reference_o2:
+        return "o1"
+    if reference_o2 and not reference_o1:
+        return "o2"
+    return "both"
+
+
+def describe_reference(evoked, reference):
+    evoked.info['description'] = f"reference={reference}"
+
+
+def saved_reference(evoked):
+    # The reference save_average noted, None for files saved before it did
+    match = REFERENCE_DESCRIPTION.match(evoked.info['description'] or "")
+    return match.group(1) if match else None
+
+
+class EvokedCatalog():
+    def __init__(self, path=DEFAULT_CATALOG):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def connect(self):
+        # Batch workers save at the same time, wait for each other's writes
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def connect_read_only(self):
+        # Never creates the file or takes a write lock
+        return sqlite3.connect(f"{Path(self.path).as_uri()}?mode=ro", uri=True, timeout=60)
+
+    def record(self, path, evoked, subject, paradigm, condition, reference,
+            highpass, lowpass, standard_band):
+        path = os.path.abspath(path)
+        row = (path, subject, paradigm, condition, reference,
+                float(highpass), float(lowpass), int(bool(standard_band)),
+                float(evoked.info['sfreq']), int(evoked.nave), len(evoked.times),
+                os.path.getmtime(path))
+        try:
+            with self.connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO evokeds VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", row)
+            connection.close()
+        except (sqlite3.Error, OSError) as e:
+            # The average itself is saved, rebuilding the catalog will pick it up
+            logging.warning(f"Could not record {path} in evoked catalog {self.path}: {e}")
+
+    def find(self, subject, paradigm, condition, reference="both", band=None):
+        """
+        Path of the saved average for one subject and condition, or None.
+
+        band is (highpass, lowpass), or None for the paradigm's standard band.
+        """
+        paths = self.find_recording(subject, paradigm, [condition], reference, band)
+        return paths[condition] if paths else None
+
+    def find_recording(self, subject, paradigm, conditions, reference="both", band=None):
+        """
+        Paths of the saved averages for every one of conditions, all from the
+        same recording, as {condition: path}. None if no recording of the
+        subject has them all.
+        """
+        query = "SELECT path, condition, mtime FROM evokeds WHERE paradigm=? AND reference=? AND subject=?"
+        params = [paradigm, reference, subject]
+        query += f" AND condition IN ({','.join('?' * len(conditions))})"
+        params += list(conditions)
+        if band is None:
+            query += " AND standard_band=1"
+        else:
+            query += " AND highpass=? AND lowpass=?"
+            params += [float(band[0]), float(band[1])]
+        query += " ORDER BY mtime DESC, path"
+
+        if not os.path.exists(self.path):
+            logging.warning(f"Evoked catalog {self.path} doesn't exist yet, build it with evoked_catalog.py")
+            return None
+        connection = self.connect_read_only()
+        try:
+            rows = connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+        # Averages from one recording share the name up to the condition,
+        # newest first within each recording
+        recordings = {}
+        for path, condition, mtime in rows:
+            # Files deleted since they were saved don't count
+            if not os.path.exists(path):
+                continue
+            paths = recordings.setdefault(AVERAGE_NAME.sub("", path), {})
+            paths.setdefault(condition, path)
+
+        # Rows are newest first, so the first complete recording is the newest
+        complete = [r for r, paths in recordings.items() if len(paths) == len(set(conditions))]
+        if len(complete) == 0:
+            for recording, paths in recordings.items():
+                missing = [c for c in conditions if c not in paths]
+                logging.warning(f"{recording} is missing {paradigm} {', '.join(missing)} averages for {subject}")
+            return None
+        if len(complete) > 1:
+            logging.warning(f"{len(complete)} recordings with {paradigm} {', '.join(conditions)} averages for {subject}, using the newest {complete[0]}")
+        return recordings[complete[0]]
+
+    def rebuild(self, root):
+        """
+        Record every average under the statistics directory root, laid out
+        as {root}/{kind}[-o1|-o2]/{subject}/*-ave.fif.
+
+        The reference is the one noted in the file, the same one save_average
+        recorded. Older files without a note get it from the directory, which
+        calls unreferenced averages "both".
+        """
+        count = 0
+        for directory, _, files in os.walk(root):
+            for name in sorted(files):
+                match = AVERAGE_NAME.search(name)
+                if not match:
+                    continue
+                path = os.path.join(directory, name)
+                paradigm, condition, highpass, lowpass = match.groups()
+                evoked = mne.read_evokeds(path, verbose=False)[0]
+                reference = saved_reference(evoked)
+                if reference is None:
+                    reference = os.path.basename(os.path.dirname(directory))
+                    reference = reference.split("-")[1] if "-" in reference else "both"
+                standard_band = highpass is None
+                if standard_band:
+                    highpass, lowpass = evoked.info['highpass'], evoked.info['lowpass']
+                self.record(path, evoked, os.path.basename(directory), paradigm, condition,
+                        reference, highpass, lowpass, standard_band)
+                count += 1
+        logging.info(f"Recorded {count} averages from {root} in {self.path}")
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the saved FMed study evoked averages for the group analysis scripts.')
+    parser.add_argument('root', help='Statistics directory to index, e.g. /study/thukdam/analyses/eeg_statistics')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--catalog', metavar='FILE', default=DEFAULT_CATALOG, help=f"Catalog to write (default {DEFAULT_CATALOG})")
+    args = parser.parse_args()
+
+    if args.verbose > 0:
+        coloredlogs.install(level='DEBUG')
+    else:
+        coloredlogs.install(level='INFO')
+
+    if not os.path.isdir(args.root):
+        logging.fatal(f"{args.root} is not a directory, exiting!")
+        sys.exit(1)
+    catalog = EvokedCatalog(args.catalog)
+    catalog.rebuild(args.root)
+
+
+if __name__ == "__main__":
+    main()
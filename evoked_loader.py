@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import logging
+import contextlib
+from fractions import Fraction
+import numpy as np
+import mne
+from scipy.signal import resample_poly
+
+# Reads saved averages onto one declared time grid, so every subject lines
+# up sample for sample whatever rate its file was saved at (older files were
+# decimated differently, --resample 512 ones are at 512Hz).
+#
+# A grid is (sfreq, tmin, n_times). Averages already on it are returned as
+# read. Others are resampled with a polyphase filter from their own sfreq,
+# then interpolated onto the grid times to take up any sub-sample offset.
+# Resampled data is cached on disk by file and grid, so it is only done once
+# per file.
+
+DEFAULT_RESAMPLE_CACHE = "/study/thukdam/analyses/eeg_statistics/resampled_evokeds"
+
+
+def grid_times(grid):
+    sfreq, tmin, n_times = grid
+    return tmin + np.arange(n_times) / sfreq
+
+
+def on_grid(evoked, grid):
+    sfreq, tmin, n_times = grid
+    return (abs(evoked.info['sfreq'] - sfreq) < 1e-6 * sfreq
+            and len(evoked.times) == n_times
+            and abs(evoked.times[0] - tmin) < 0.5 / sfreq)
+
+
+def resample_to_grid(data, sfreq, tmin, grid):
+    # Polyphase low-passes below the new Nyquist frequency, so nothing
+    # aliases when going down in rate
+    ratio = Fraction(grid[0] / sfreq).limit_denominator(1000)
+    resampled = resample_poly(data, ratio.numerator, ratio.denominator, axis=-1, padtype='line')
+    times = tmin + np.arange(resampled.shape[-1]) / (sfreq * ratio.numerator / ratio.denominator)
+    target = grid_times(grid)
+    # np.interp holds the end values past the data, fine for part of a sample
+    if target[0] < times[0] - 1 / sfreq or target[-1] > times[-1] + 1 / sfreq:
+        logging.warning(f"Data from {times[0]:.4f}s to {times[-1]:.4f}s doesn't cover the grid from {target[0]:.4f}s to {target[-1]:.4f}s, holding the end values")
+    return np.array([np.interp(target, times, row) for row in resampled])
+
+
+def cache_path(cache_dir, path, grid, baseline):
+    stat = os.stat(path)
+    description = {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'grid': [float(g) for g in grid],
+        'baseline': list(baseline) if baseline else None,
+    }
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.npy")
+
+
+def read_evokeds(path, grid, baseline=None, cache_dir=None):
+    """
+    mne.read_evokeds(path, baseline=baseline), with every Evoked put on grid
+    (sfreq, tmin, n_times). Pass cache_dir to keep resampled data for next time.
+    """
+    evokeds = mne.read_evokeds(path, baseline=baseline)
+    if all(on_grid(e, grid) for e in evokeds):
+        return evokeds
+
+    cached = cache_path(cache_dir, path, grid, baseline) if cache_dir else None
+    if cached and os.path.exists(cached):
+        data = np.load(cached)
+        logging.info(f"Loaded {path} resampled to {grid[0]:.1f}Hz from {cached}")
+    else:
+        logging.warning(f"Resampling {path} from {evokeds[0].info['sfreq']:.1f}Hz and {len(evokeds[0].times)} samples onto the {grid[0]:.1f}Hz, {grid[2]} sample grid")
+        data = np.array([resample_to_grid(e.data, e.info['sfreq'], e.times[0], grid) for e in evokeds])
+        if cached:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cached}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as file:
+                    np.save(file, data)
+                os.replace(tmp_path, cached)
+            except OSError as e:
+                logging.warning(f"Could not cache resampled {path} in {cache_dir}: {e}")
+
+    resampled = []
+    for evoked, d in zip(evokeds, data):
+        info = evoked.info.copy()
+        # Newer MNE locks these fields so they can only be set from inside
+        with getattr(info, '_unlock', contextlib.nullcontext)():
+            info['sfreq'] = float(grid[0])
+            info['lowpass'] = min(info['lowpass'], grid[0] / 2)
+        evoked = mne.EvokedArray(d, info, tmin=grid[1], comment=evoked.comment,
+                nave=evoked.nave, verbose=False)
+        if baseline:
+            evoked.apply_baseline(baseline, verbose=False)
+        resampled.append(evoked)
+    return resampled
@@ -0,0 +1,87 @@
+import os
+import shutil
+import logging
+import numpy as np
+
+# Every subject's evokeds for one paradigm stacked into one array, shaped
+# subject x condition x channel x time, so the analysis scripts can open the
+# whole cohort at once instead of reading dozens of FIF files and pulling
+# channels out of Evoked objects one at a time.
+#
+# A store is a directory with the array as data.npy, opened memory-mapped,
+# and sidecar.npz with the times, nave (subject x condition), subject IDs,
+# condition names and channel names.
+
+DATA_NAME = "data.npy"
+SIDECAR_NAME = "sidecar.npz"
+
+
+def stack(subjects, evokeds):
+    """
+    Build a store from Evoked objects in memory.
+
+    evokeds maps each condition name to a list of Evoked, one per subject
+    in subjects, all with the same channels and number of samples.
+    """
+    conditions = list(evokeds)
+    first = evokeds[conditions[0]][0]
+    for condition in conditions:
+        for sid, evoked in zip(subjects, evokeds[condition]):
+            if evoked.ch_names != first.ch_names or len(evoked.times) != len(first.times):
+                raise ValueError(f"{condition} average for {sid} doesn't have the same channels and samples as {subjects[0]}")
+
+    data = np.stack([np.stack([e.data for e in evokeds[c]]) for c in conditions], axis=1)
+    nave = np.array([[e.nave for e in evokeds[c]] for c in conditions]).T
+    return {
+        'data': data,
+        'times': first.times.copy(),
+        'nave': nave,
+        'subjects': list(subjects),
+        'conditions': conditions,
+        'ch_names': list(first.ch_names),
+    }
+
+
+def save(path, store):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, DATA_NAME), np.asarray(store['data']))
+    np.savez(os.path.join(tmp_path, SIDECAR_NAME),
+            times=store['times'],
+            nave=store['nave'],
+            subjects=np.array(store['subjects']),
+            conditions=np.array(store['conditions']),
+            ch_names=np.array(store['ch_names']))
+    # Replace a previous export of the same store
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    logging.info(f"Saved {len(store['subjects'])} subjects x {len(store['conditions'])} conditions to group store {path}")
+
+
+def load(path):
+    data = np.load(os.path.join(path, DATA_NAME), mmap_mode='r')
+    with np.load(os.path.join(path, SIDECAR_NAME)) as sidecar:
+        store = {
+            'data': data,
+            'times': sidecar['times'],
+            'nave': sidecar['nave'],
+            'subjects': sidecar['subjects'].tolist(),
+            'conditions': sidecar['conditions'].tolist(),
+            'ch_names': sidecar['ch_names'].tolist(),
+        }
+    logging.info(f"Opened group store {path} with {len(store['subjects'])} subjects x {len(store['conditions'])} conditions")
+    return store
+
+
+def select(store, subjects, condition):
+    """
+    The subject x channel x time array of one condition for subjects, in
+    their order, and their nave.
+    """
+    missing = [sid for sid in subjects if sid not in store['subjects']]
+    if missing:
+        raise KeyError(f"Subjects {missing} are not in the group store")
+    rows = [store['subjects'].index(sid) for sid in subjects]
+    column = store['conditions'].index(condition)
+    return store['data'][rows, column], store['nave'][rows, column]
@@ -8,7 +8,7 @@ import mne
 from mne.preprocessing import ICA, create_ecg_epochs
 import matplotlib.pyplot as plt
 
-from eeg_shared import BDFWithMetadata
+from eeg_shared import BDFWithMetadata, add_processing_arguments, parse_bands
 
 parser = argparse.ArgumentParser(description='Automate FMed study artifact rejection and analysis of MMN. By default loads the file for viewing')
 
@@ -22,23 +22,23 @@ parser.add_argument('--dms-mean', action='store_true', help="Mean deviant minus
 parser.add_argument('--epoch-image', action='store_true', help="Very slow colormap image of epochs")
 parser.add_argument('--epoch-view', action='store_true', help="Simple linear view of epochs, default end view")
 parser.add_argument('--psd', metavar='HZ', action='store', help="Plot power spectral density up to HZ")
-parser.add_argument('--force', action='store_true', help="Force running outside of raw-data/subjects, saving masks to current directory")
 parser.add_argument('--save-average', action='store_true', help="Save averaged evoked epochs in a standard MNE file")
 parser.add_argument('--all', action='store_true', help="Generate all plots and save average evoked epochs")
-parser.add_argument('--initial-laptop', action='store_true', help="Data is from 2013I (initial settings) north laptop after restore")
 parser.add_argument('--bandpass-from', metavar='HZ', action='store', help="Lower frequency of bandpass (default is 1)")
 parser.add_argument('--bandpass-to', metavar='HZ', action='store', help="Higher frequency of bandpass (default is 35)")
-parser.add_argument('--no-reference', action='store_true', help="Do not reference mastoids")
-parser.add_argument('--reference-o1', action='store_true', help="Only reference o1 mastoid")
-parser.add_argument('--reference-o2', action='store_true', help="Only reference o2 mastoid")
 parser.add_argument('--no-events', action='store_true', help="Do not show events")
 parser.add_argument('--display-huge', action='store_true', help="Zoom way out to display entire file")
-parser.add_argument('--no-crop', action='store_true', help="Do not crop file")
-parser.add_argument('--no-notch', action='store_true', help="Do not notch filter at 50Hz")
 
+add_processing_arguments(parser, "mmn")
 
 args = parser.parse_args()
 
+# Sweeps and streamed averages never hold the epochs the plots are drawn from
+if (args.bands or args.stream_average) and any([args.topo, args.shell, args.dms, args.dms_mean, args.epoch_image, args.epoch_view, args.all]):
+    parser.error("--bands and --stream-average only save averages, plot in a run without them")
+if (args.bands or args.stream_average) and not args.save_average:
+    parser.error("--bands and --stream-average only save averages, add --save-average")
+
 if args.verbose > 0:
     coloredlogs.install(level='DEBUG')
 else:                       
@@ -47,7 +47,7 @@ else:
 
 raw_file = args.input
 
-f = BDFWithMetadata(raw_file, "mmn", args.force, is_2013I=args.initial_laptop, no_reference=args.no_reference, reference_o1=args.reference_o1, reference_o2=args.reference_o2, no_notch=(args.no_notch or args.skip_view), no_crop=args.no_crop)
+f = BDFWithMetadata(raw_file, "mmn", args, no_notch=(args.no_notch or args.skip_view))
 f.load()
 if args.bandpass_from:
     f.highpass = float(args.bandpass_from)
@@ -55,6 +55,11 @@ if args.bandpass_from:
 if args.bandpass_to:
     f.lowpass = float(args.bandpass_to)
     logging.info(f"Overriding lowpass frequency of band to {f.lowpass}Hz")
+if args.all_references:
+    # Every reference variant from the one load, each to its usual output path
+    bands = parse_bands(args.bands) if args.bands else None
+    f.save_reference_averages(bands=bands, threads=args.band_threads)
+    sys.exit()
 if not args.skip_view:
     f.artifact_rejection(args.display_huge, args.no_events)
 
@@ -62,18 +67,17 @@ if not args.skip_view:
 if args.psd or args.all:
     f.psd(int(args.psd or 120))
 
+if args.bands or args.stream_average:
+    # Each band is filtered from the same preprocessed data and saved under its own name
+    bands = parse_bands(args.bands) if args.bands else None
+    f.build_epochs(bands=bands, threads=args.band_threads)
+    f.decimate_epochs()
+    if args.save_average or args.all:
+        f.save_average()
+    sys.exit()
 
 epochs = f.build_epochs()
-# Only decimate if srate is high
-if f.raw.info['sfreq'] > 16000:
-    # All the data was just reduced by a factor of 3 because that fits in memory better
-    # In the future, we probably want to reduce down to 512hz as the manual process did
-    # factor = f.raw.info['sfreq'] / 512
-    factor = 3
-    logging.info(f"Decimating epochs in memory by a factor of {factor}")
-    epochs.decimate(factor)
-else:
-    logging.info("File already decimated, not decimating")
+epochs = f.decimate_epochs()
 
 
 if args.dms or args.dms_mean or args.all:
@@ -2,30 +2,41 @@
 
 import os
 import sys
-import glob
 import argparse
 import logging
 import coloredlogs
 import datetime
 import numpy as np
 from scipy import stats
-from scipy import integrate
 import mne
 import csv
 from statsmodels.stats.weightstats import ttest_ind
 
+from evoked_catalog import EvokedCatalog, DEFAULT_CATALOG
+import evoked_loader
+import group_store
+import window_amplitude
+import time_resolved
+
 # Mutated from mmn_grand_average.py to do statistics
 
 # Baseline to the average of the section from the start of the epoch to the event
 BASELINE = (None, 0.1)
-# Expected number of samples in a decimated statistics file
-EXPECTED_SAMPLES = 2731
+# Every average is put on this grid before combining: -0.1s to 0.4s epochs
+# at 16384Hz decimated by 3 give 2731 samples starting at sample -1638
+TIME_GRID = (16384 / 3, -1638 / 16384, 2731)
 
 timestamp = datetime.datetime.now().isoformat()
 
 parser = argparse.ArgumentParser(description='Automate FMed study statistical analysis of MMN.')
 parser.add_argument('-v', '--verbose', action='count', default=0)
 parser.add_argument('--debug', action="store_true")
+parser.add_argument('--store', metavar='DIR', help="Read every subject's averages from a group store made with --export-store instead of the FIF files")
+parser.add_argument('--export-store', metavar='DIR', help="Save every subject's averages as a group store in DIR for later --store runs")
+parser.add_argument('--resample-cache', metavar='DIR', default=evoked_loader.DEFAULT_RESAMPLE_CACHE, help="Keep averages resampled onto the common time grid here")
+parser.add_argument('--time-resolved', action='store_true', help="Also t test the groups at every sample of every channel, FDR corrected, saved and plotted in the stats directory")
+parser.add_argument('--fdr-alpha', metavar='ALPHA', type=float, default=0.05, help="False discovery rate for --time-resolved (default 0.05)")
+parser.add_argument('--catalog', metavar='FILE', default=DEFAULT_CATALOG, help="Catalog of saved averages to look subjects up in (build it with evoked_catalog.py)")
 # parser.add_argument('subject', nargs='+')
 
 args = parser.parse_args()
@@ -43,32 +54,12 @@ group2_name = "postmortem"
 
 
 INPUT_DIR = "/study/thukdam/analyses/eeg_statistics/mmn"
-GOOD_TIMES = None
+catalog = EvokedCatalog(args.catalog)
 
 logging.info(f"Reading group 1 and group 2 from {INPUT_DIR}")
 
 def read_evokeds(f):
-    global GOOD_TIMES
-    es = mne.read_evokeds(f, baseline=BASELINE)
-    samples = es[0].data.shape[1]
-    if samples != EXPECTED_SAMPLES:
-        """
-        Now, we're expecting a certain sample rate so that we end up with 2731 samples from these arrays.
-        But we have old cruddy data that has been decimated differently.
-        So we resample and force the timepoints to be identical (there's a little jitter)
-
-        So far we only hit one file, so I am being a bad person and hard coding a resampling rate
-        that will get files like that one to match. If this does NOT fix future files, we'll have
-        to figure out how to get at the sample rate of the MNE Evoked lists, and do it dynamically.
-        Couldn't find it in a few hours of poking.
-        """
-        logging.warning(f"Resampling on {f}, did not get expected decimated statistics length {EXPECTED_SAMPLES}, got {samples}...")
-
-        es[0].resample(5441)
-        es[0].times = GOOD_TIMES
-    else:
-        GOOD_TIMES = es[0].times
-    return es
+    return evoked_loader.read_evokeds(f, TIME_GRID, BASELINE, args.resample_cache)
 
 def load_group(group):
     total = []
@@ -76,18 +67,15 @@ def load_group(group):
     deviant = []
     weights = []
     for sid in group:
-        # Find the statistics files for this subject
-        def find_file(kind):
-            path = f"{INPUT_DIR}/{sid}/*{kind}-ave.fif"
-            find = glob.glob(path)
-            if len(find) == 0:
-                logging.fatal(f"No {kind} summary file found for {sid}")
-                sys.exit(1)
-            return find[0]
-
-        total_file = find_file("all")
-        standard_file = find_file("standard")
-        deviant_file = find_file("deviant")
+        # Find the statistics files for this subject, all from one recording
+        paths = catalog.find_recording(sid, "mmn", ["all", "standard", "deviant"])
+        if paths is None:
+            logging.fatal(f"No recording with all, standard and deviant summary files found for {sid} in {args.catalog}")
+            sys.exit(1)
+
+        total_file = paths["all"]
+        standard_file = paths["standard"]
+        deviant_file = paths["deviant"]
 
         total += read_evokeds(total_file)
         standard += read_evokeds(standard_file)
@@ -107,48 +95,60 @@ def load_group(group):
         'nave': nave,
     }
 
-data1 = load_group(group1)
-data2 = load_group(group2)
-
-
-def amplitude(electrode, evoked, window_start_ms, window_end_ms):
-    pick = evoked.ch_names.index(electrode)
-
-    times = evoked.times
-    data = evoked.data[pick]
+if args.store:
+    store = group_store.load(args.store)
+else:
+    data1 = load_group(group1)
+    data2 = load_group(group2)
+    # Same layout as the saved group store, so the rest works on either
+    store = group_store.stack(group1 + group2, {
+        'all': data1['total'] + data2['total'],
+        'standard': data1['standard'] + data2['standard'],
+        'deviant': data1['deviant'] + data2['deviant'],
+        'difference': data1['difference'] + data2['difference'],
+    })
+    if args.export_store:
+        group_store.save(args.export_store, store)
+
+def group_arrays(group):
+    # Subject x channel x time arrays of each condition for one group
+    total, nave = group_store.select(store, group, 'all')
+    return {
+        'total': total,
+        'standard': group_store.select(store, group, 'standard')[0],
+        'deviant': group_store.select(store, group, 'deviant')[0],
+        'difference': group_store.select(store, group, 'difference')[0],
+        'nave': list(nave),
+    }
 
-    # We have to crop to the window
-    window_start_s = window_start_ms / 1000
-    window_end_s = window_end_ms / 1000
+data1 = group_arrays(group1)
+data2 = group_arrays(group2)
 
-    # NOTE: There has to be a more idiomatic way to find the first index
-    # matching a filter but ... here we are
-    start_index = np.where(times>=window_start_s)[0][0]
-    end_index = np.where(times>=window_end_s)[0][0]
 
-    data_window = data[start_index:end_index]
-    times_window = times[start_index:end_index]
+def amplitudes(electrode, integrals, windows_ms):
+    # Area amplitude in each window for every subject, subject x window
+    pick = store['ch_names'].index(electrode)
+    # Area under the curve / s instead of combining the evoked data using an
+    # average, divided by the length of the window to get back to uV
+    return window_amplitude.window_amplitudes(integrals, windows_ms)[:, pick]
 
-    # Now, instead of combining the evoked data using an average,
-    # we calculate area under the curve / s
-    # NOTE: this is resulting in uV * seconds as the unit, not ms
-    area = integrate.simps(data_window, times_window)
 
-    # Now, we multiply by 1000 to get ms and divide by the length of the window to get uV
-    return area * 1000 / (window_end_ms - window_start_ms)
+MMN_START = 90
+MMN_END = 180
 
+def get_amplitudes(electrode, integrals):
+    return list(amplitudes(electrode, integrals, [(MMN_START, MMN_END)])[:, 0])
 
-def get_amplitudes(electrode, data):
-    MMN_START = 90
-    MMN_END = 180
-    return [ amplitude(electrode, x, MMN_START, MMN_END) for x in data ]
 
+# Integrate each group once, any window after that is a lookup
+group1_integrals = window_amplitude.cumulative(data1['difference'], store['times'])
+group2_integrals = window_amplitude.cumulative(data2['difference'], store['times'])
 
-group1_difference_fz = get_amplitudes('Fz', data1['difference'])
-group2_difference_fz = get_amplitudes('Fz', data2['difference'])
+group1_difference_fz = get_amplitudes('Fz', group1_integrals)
+group2_difference_fz = get_amplitudes('Fz', group2_integrals)
 
-group1_difference_cz = get_amplitudes('Cz', data1['difference'])
-group2_difference_cz = get_amplitudes('Cz', data2['difference'])
+group1_difference_cz = get_amplitudes('Cz', group1_integrals)
+group2_difference_cz = get_amplitudes('Cz', group2_integrals)
 
 # Store "good" trial counts for each participant and electrode...
 # We have to do this per-electrode to calculate weights when 
@@ -214,3 +214,16 @@ print(f"Group 1 [{group1_name}] fz difference mean: {np.mean(wg1f)} std: {np.std
 print(f"Group 1 [{group1_name}] cz difference mean: {np.mean(wg1c)} std: {np.std(wg1c)}")
 print(f"Group 2 [{group2_name}] fz difference mean: {np.mean(wg2f)} std: {np.std(wg2f)}")
 print(f"Group 2 [{group2_name}] cz difference mean: {np.mean(wg2c)} std: {np.std(wg2c)}")
+
+
+if args.time_resolved:
+    # Same weighting as above, leaving out FM1618's Fz here too
+    keep1 = np.ones((len(group1), len(store['ch_names'])), dtype=bool)
+    keep1[group1.index('FM1618'), store['ch_names'].index('Fz')] = False
+    result = time_resolved.group_test(data1['difference'], data2['difference'],
+            time_resolved.trial_weights(data1['nave'], keep1),
+            time_resolved.trial_weights(data2['nave']),
+            alpha=args.fdr_alpha)
+    time_resolved.save(OUTPUT_DIR, result, store['times'], store['ch_names'])
+    time_resolved.plot(OUTPUT_DIR, result, store['times'], store['ch_names'],
+            f"MMN difference, {group1_name} vs {group2_name}", electrodes=['Fz', 'Cz'])
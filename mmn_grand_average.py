@@ -2,7 +2,6 @@
 
 import os
 import sys
-import glob
 import argparse
 import logging
 import coloredlogs
@@ -11,10 +10,14 @@ import numpy as np
 from matplotlib import pyplot as plt
 import mne
 
+from evoked_catalog import EvokedCatalog, DEFAULT_CATALOG
+import evoked_loader
+
 # Baseline to the average of the section from the start of the epoch to the event
 BASELINE = (None, 0.1)
-# Expected number of samples in a decimated statistics file
-EXPECTED_SAMPLES = 2731
+# Every average is put on this grid before combining: -0.1s to 0.4s epochs
+# at 16384Hz decimated by 3 give 2731 samples starting at sample -1638
+TIME_GRID = (16384 / 3, -1638 / 16384, 2731)
 
 timestamp = datetime.datetime.now().isoformat()
 
@@ -22,6 +25,8 @@ parser = argparse.ArgumentParser(description='Automate FMed study grand averagin
 parser.add_argument('-v', '--verbose', action='count', default=0)
 parser.add_argument('-n', '--name', default=timestamp.replace(":","."))
 parser.add_argument('--debug', action="store_true")
+parser.add_argument('--resample-cache', metavar='DIR', default=evoked_loader.DEFAULT_RESAMPLE_CACHE, help="Keep averages resampled onto the common time grid here")
+parser.add_argument('--catalog', metavar='FILE', default=DEFAULT_CATALOG, help="Catalog of saved averages to look subjects up in (build it with evoked_catalog.py)")
 parser.add_argument('subject', nargs='+')
 
 args = parser.parse_args()
@@ -35,7 +40,7 @@ else:
 INPUT_DIR = "/study/thukdam/analyses/eeg_statistics/mmn"
 OUTPUT_DIR = f"/scratch/dfitch/plots/{args.name}"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
-GOOD_TIMES = None
+catalog = EvokedCatalog(args.catalog)
 
 with open(f"{OUTPUT_DIR}/README.txt", 'w') as f:
     f.write(' '.join(sys.argv) + "\n\n")
@@ -46,43 +51,21 @@ with open(f"{OUTPUT_DIR}/README.txt", 'w') as f:
 logging.info(f"Reading {args.subject} from {INPUT_DIR} and writing to {OUTPUT_DIR}")
 
 def read_evokeds(f):
-    global GOOD_TIMES
-    es = mne.read_evokeds(f, baseline=BASELINE)
-    if es[0].data.shape[1] != EXPECTED_SAMPLES:
-        """
-        Now, we're expecting a certain sample rate so that we end up with 2731 samples from these arrays.
-        But we have old cruddy data that has been decimated differently.
-        So we resample and force the timepoints to be identical (there's a little jitter)
-
-        So far we only hit one file, so I am being a bad person and hard coding a resampling rate
-        that will get files like that one to match. If this does NOT fix future files, we'll have
-        to figure out how to get at the sample rate of the MNE Evoked lists, and do it dynamically.
-        Couldn't find it in a few hours of poking.
-        """
-        logging.warning(f"Resampling on {f}, did not get expected decimated statistics length {EXPECTED_SAMPLES}")
-
-        es[0].resample(5441)
-        es[0].times = GOOD_TIMES
-    else:
-        GOOD_TIMES = es[0].times
-    return es
+    return evoked_loader.read_evokeds(f, TIME_GRID, BASELINE, args.resample_cache)
 
 total = []
 standard = []
 deviant = []
 for sid in args.subject:
-    # Find the statistics files for this subject
-    def find_file(kind):
-        path = f"{INPUT_DIR}/{sid}/*{kind}-ave.fif"
-        find = glob.glob(path)
-        if len(find) == 0:
-            logging.fatal(f"No {kind} summary file found for {sid}")
-            sys.exit(1)
-        return find[0]
-
-    total_file = find_file("all")
-    standard_file = find_file("standard")
-    deviant_file = find_file("deviant")
+    # Find the statistics files for this subject, all from one recording
+    paths = catalog.find_recording(sid, "mmn", ["all", "standard", "deviant"])
+    if paths is None:
+        logging.fatal(f"No recording with all, standard and deviant summary files found for {sid} in {args.catalog}")
+        sys.exit(1)
+
+    total_file = paths["all"]
+    standard_file = paths["standard"]
+    deviant_file = paths["deviant"]
 
     total += read_evokeds(total_file)
     standard += read_evokeds(standard_file)
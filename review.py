@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import logging
+import coloredlogs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib.pyplot as plt
+
+from eeg_shared import BDFWithMetadata, NeedsManualReview, expand_inputs, add_processing_arguments
+
+# Artifact rejection over a queue of files, one view after another like
+# running mmn.py or abr.py on each in turn. While one subject is being
+# annotated, the next ones are read, referenced and notch filtered in a
+# background thread, so the next view opens straight away.
+#
+# Reading and filtering spend nearly all their time in numpy and the BDF
+# reader, which let go of the GIL, so a thread is enough and the loaded
+# data doesn't have to be copied back from another process. Subjects are
+# handed over in queue order and at most --keep are held in memory at once,
+# counting the one on screen.
+
+
+def load_subject(path, kind, options):
+    # Runs in the background, so never stops to ask for the crop, that is
+    # left for when the subject comes up (see review_queue)
+    f = open_subject(path, kind, options, interactive=False)
+    f.load()
+    if options.display_huge:
+        f.envelopes()
+    return f
+
+
+def open_subject(path, kind, options, interactive):
+    return BDFWithMetadata(path, kind, options, interactive=interactive)
+
+
+def wait_for(path, kind, future, options):
+    """
+    The loaded subject from the background, or loaded here if its events
+    have to be found by hand. None if it can't be loaded at all.
+    """
+    try:
+        return future.result()
+    except NeedsManualReview as e:
+        logging.warning(f"{e}, loading it here to pick the times by hand")
+        f = open_subject(path, kind, options, interactive=True)
+        f.load()
+        return f
+    except SystemExit:
+        # eeg_shared exits when it can't continue, it has already logged why
+        logging.error(f"Skipping {path}, it could not be loaded")
+    except MemoryError:
+        logging.error(f"Skipping {path}, ran out of memory loading it, try a smaller --keep")
+    except Exception:
+        logging.exception(f"Skipping {path}, failed loading it")
+    return None
+
+
+def review_queue(paths, kind, options, keep):
+    queue = deque(paths)
+    ahead = deque()
+    done = 0
+    staging = {True: 0, False: 0}
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while queue or ahead:
+            if not ahead:
+                path = queue.popleft()
+                ahead.append((path, pool.submit(load_subject, path, kind, options)))
+            path, future = ahead.popleft()
+            # Queue up the next ones behind this one, the single loader thread
+            # takes them in order
+            while queue and len(ahead) < keep - 1:
+                next_path = queue.popleft()
+                ahead.append((next_path, pool.submit(load_subject, next_path, kind, options)))
+
+            if not future.done():
+                logging.info(f"Waiting for {path} to finish loading")
+            f = wait_for(path, kind, future, options)
+            # The future holds on to the subject too, only f should from here
+            del future
+            done += 1
+            if f is None:
+                continue
+            if f.staging_hit is not None:
+                staging[f.staging_hit] += 1
+            logging.info(f"[{done}/{len(paths)}] Reviewing {path}")
+            f.artifact_rejection(options.display_huge, options.no_events)
+            if options.save_average:
+                f.build_epochs()
+                if f.is_mmn():
+                    f.decimate_epochs()
+                f.save_average()
+            # Let go of this subject before the next one is loaded in its place
+            plt.close('all')
+            del f
+
+    if options.staging_dir:
+        logging.info(f"Staging cache: {staging[True]} hits, {staging[False]} misses")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Review artifacts in a queue of FMed study BDF files, loading the next files in the background while the current one is open.')
+
+    parser.add_argument('input', nargs='*', help='BDF paths or glob patterns (quote globs so the shell does not expand them)')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-m', '--manifest', action='append', default=[], help="File listing one BDF path or glob per line, can be given more than once")
+    parser.add_argument('-k', '--kind', choices=["mmn", "abr"], required=True, help="Which paradigm to review")
+    parser.add_argument('--keep', metavar='N', type=int, default=2, help="Hold at most N subjects in memory, the one being reviewed and N-1 loading ahead (default 2)")
+    parser.add_argument('--save-average', action='store_true', help="Save averaged evoked epochs after reviewing each file")
+    parser.add_argument('--no-events', action='store_true', help="Do not show events")
+    parser.add_argument('--display-huge', action='store_true', help="Zoom way out to display entire file")
+    add_processing_arguments(parser, averaging=False)
+
+    args = parser.parse_args()
+
+    if args.verbose > 0:
+        coloredlogs.install(level='DEBUG')
+    else:
+        coloredlogs.install(level='INFO')
+
+    paths = expand_inputs(args.input, args.manifest)
+    if len(paths) == 0:
+        logging.fatal("No input files found, exiting!")
+        sys.exit(1)
+    if args.keep < 1:
+        logging.fatal("--keep has to be at least 1")
+        sys.exit(1)
+
+    logging.info(f"Reviewing {len(paths)} {args.kind} files, keeping up to {args.keep} loaded")
+    review_queue(paths, args.kind, args, args.keep)
+
+
+if __name__ == "__main__":
+    main()
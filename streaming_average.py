@@ -0,0 +1,71 @@
+import logging
+import numpy as np
+import mne
+
+# Averages evoked responses straight from the continuous data, without
+# building an mne.Epochs object first.
+#
+# Each condition only keeps a running sum the size of one epoch and a count,
+# so memory doesn't grow with the number of trials. Epochs are picked out
+# and baselined the same way mne.Epochs does it with our settings
+# (baseline (None, 0), no amplitude rejection), and baseline correction
+# commutes with averaging, so the evokeds come out the same as
+# epochs[condition].average(). Epochs overlapping bad annotations should
+# already be gone from the events, see artifact_mask.
+
+
+def epoch_samples(sfreq, tmin, tmax):
+    # Sample offsets of the first and last sample of an epoch, like mne.Epochs
+    return int(round(tmin * sfreq)), int(round(tmax * sfreq))
+
+
+def stream_averages(raw, events, event_id, tmin, tmax, picks, conditions):
+    """
+    Average epochs around events for each condition in one walk over the
+    events.
+
+    conditions maps an output name to the event names it averages, e.g.
+    {'deviant': ['Deviant'], 'all': list(event_id)}. Returns a dict of
+    output name to baselined mne.Evoked with its nave set.
+    """
+    sfreq = raw.info['sfreq']
+    first, last = epoch_samples(sfreq, tmin, tmax)
+    n_times = last - first + 1
+    picks = mne.pick_channels(raw.ch_names, picks, ordered=True)
+
+    # Which conditions each event code feeds into
+    names = {code: name for name, code in event_id.items()}
+    feeds = {code: [c for c, wanted in conditions.items() if name in wanted]
+            for code, name in names.items()}
+
+    sums = {c: np.zeros((len(picks), n_times)) for c in conditions}
+    counts = {c: {} for c in conditions}
+    for sample, _, code in events:
+        if code not in feeds:
+            continue
+        start = int(round(sample + first)) - raw.first_samp
+        stop = start + n_times
+        if start < 0 or stop > raw.n_times:
+            continue
+        window = raw._data[picks, start:stop]
+        for c in feeds[code]:
+            sums[c] += window
+            counts[c][names[code]] = counts[c].get(names[code], 0) + 1
+    logging.info(f"Streamed {len(events)} events into {len(conditions)} averages")
+
+    info = mne.pick_info(raw.info, picks)
+    evokeds = {}
+    for c in conditions:
+        nave = sum(counts[c].values())
+        if nave == 0:
+            raise ValueError(f"No epochs left to average for {c}")
+        # Same comment Epochs.average gives
+        if len(conditions[c]) == 1:
+            comment = conditions[c][0]
+        else:
+            comment = " + ".join(f"{counts[c][name] / nave:0.2f} × {name}"
+                    for name in conditions[c] if counts[c].get(name))
+        evoked = mne.EvokedArray(sums[c] / nave, info, tmin=first / sfreq,
+                comment=comment, nave=nave, verbose=False)
+        evokeds[c] = evoked.apply_baseline((None, 0), verbose=False)
+    return evokeds
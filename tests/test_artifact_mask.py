@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+import numpy as np
+import mne
+
+import eeg_shared
+
+SFREQ = 1024
+
+
+def recording(tmp_path, seconds=20, artifact_at=None):
+    # A quiet 10Hz sine on the epoch channels, with an optional big jump
+    times = np.arange(int(seconds * SFREQ)) / SFREQ
+    data = np.tile(10e-6 * np.sin(2 * np.pi * 10 * times), (len(eeg_shared.EPOCH_CHANNELS), 1))
+    if artifact_at is not None:
+        start = int(artifact_at * SFREQ)
+        data[:, start:start + SFREQ // 10] += 500e-6
+    info = mne.create_info(eeg_shared.EPOCH_CHANNELS, SFREQ, 'eeg')
+    f = eeg_shared.BDFWithMetadata(str(tmp_path / "subject.bdf"), "mmn", force=True,
+            interactive=False, auto_artifacts=True)
+    f.raw = mne.io.RawArray(data, info, verbose=False)
+    # BDFs always have one, and saved masks are relative to it
+    f.raw.set_meas_date(datetime(2014, 5, 1, 9, 0, tzinfo=timezone.utc))
+    return f
+
+
+def test_clean_recording_saves_no_mask(tmp_path):
+    # Twice, the second run used to fail reading back an empty mask
+    for _ in range(2):
+        f = recording(tmp_path)
+        f.load_annotations()
+        assert len(f.raw.annotations) == 0
+    assert not (tmp_path / "subject.bdf.mmn_artifact_mask.csv").exists()
+
+
+def test_empty_mask_is_ignored(tmp_path):
+    (tmp_path / "subject.bdf.mmn_artifact_mask.csv").write_text("onset,duration,description\n")
+    f = recording(tmp_path)
+    f.load_annotations()
+    assert len(f.raw.annotations) == 0
+
+
+def test_proposed_mask_round_trips(tmp_path):
+    f = recording(tmp_path, artifact_at=10)
+    f.load_annotations()
+    proposed = f.raw.annotations
+    assert len(proposed) > 0
+    assert (tmp_path / "subject.bdf.mmn_artifact_mask.csv").exists()
+
+    # The next run reads the saved mask instead of detecting again
+    f = recording(tmp_path)
+    f.load_annotations()
+    assert list(f.raw.annotations.description) == list(proposed.description)
+    np.testing.assert_allclose(f.raw.annotations.onset, proposed.onset, atol=1e-3)
+    np.testing.assert_allclose(f.raw.annotations.duration, proposed.duration, atol=1e-3)
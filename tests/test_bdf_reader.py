@@ -0,0 +1,100 @@
+import numpy as np
+import mne
+
+import bdf_reader
+
+SFREQ = 256
+RECORDS = 6
+# Like the 17 channel files, the EXG channels twice (MNE calls the first set
+# EXG1-0 and so on) with something else in between
+LABELS = bdf_reader.EXG_CHANNELS + ['EXG7', 'EXG8'] + bdf_reader.EXG_CHANNELS + ['Ana1', 'Ana2']
+# Onset and value of each trigger, the last one still on at the end
+TRIGGERS = [(10, 2), (300, 3), (305, 4), (700, 2), (1100, 3), (1535, 4)]
+
+
+def field(values, width):
+    return b''.join(str(v).ljust(width)[:width].encode('latin-1') for v in values)
+
+
+def write_bdf(path, data, status, header_records, partial_bytes):
+    # Digital values (channel x sample) plus Status, one second records
+    signals = LABELS + [bdf_reader.STATUS_CHANNEL]
+    n = len(signals)
+    eeg = len(LABELS)
+    fixed = (b'\xffBIOSEMI' + field(['subject'], 80) + field(['recording'], 80)
+            + b'01.05.14' + b'09.30.00' + field([256 * (n + 1)], 8) + field(['24BIT'], 44)
+            + field([header_records], 8) + field([1], 8) + field([n], 4))
+    signal_header = (field(signals, 16)
+            + field(['Active electrode'] * eeg + ['Triggers and Status'], 80)
+            + field(['uV'] * eeg + ['Boolean'], 8)
+            + field([-262144] * eeg + [-8388608], 8) + field([262143] * eeg + [8388607], 8)
+            + field([-8388608] * n, 8) + field([8388607] * n, 8)
+            + field(['HP:DC; LP:417 Hz'] * eeg + ['No filtering'], 80)
+            + field([SFREQ] * n, 8) + field([''] * n, 32))
+    rows = np.vstack([data, status]) & 0xFFFFFF
+    with open(path, 'wb') as file:
+        file.write(fixed + signal_header)
+        for r in range(RECORDS):
+            record = rows[:, r * SFREQ:(r + 1) * SFREQ]
+            samples = np.stack([record & 0xFF, (record >> 8) & 0xFF, record >> 16], axis=-1)
+            file.write(samples.astype(np.uint8).tobytes())
+        # A record that was cut off when the recording stopped
+        file.write(b'\0' * partial_bytes)
+
+
+def recording(tmp_path, header_records=RECORDS, partial_bytes=0):
+    rng = np.random.default_rng(0)
+    n = SFREQ * RECORDS
+    data = rng.integers(-2 ** 23, 2 ** 23, (len(LABELS), n))
+    # High bits are Biosemi's CMS and battery flags, not triggers
+    status = np.full(n, 1 << 20)
+    for onset, value in TRIGGERS:
+        status[onset:onset + 20] |= value
+    path = str(tmp_path / "subject.bdf")
+    write_bdf(path, data, status[np.newaxis], header_records, partial_bytes)
+    return path
+
+
+def mne_subset(raw):
+    # What load_file keeps of a full read
+    raw = raw.copy().pick([f"{c}-0" for c in bdf_reader.EXG_CHANNELS] + [bdf_reader.STATUS_CHANNEL])
+    raw.rename_channels({f"{c}-0": c for c in bdf_reader.EXG_CHANNELS})
+    return raw
+
+
+def test_matches_mne_across_records(tmp_path):
+    path = recording(tmp_path)
+    full = mne.io.read_raw_bdf(path, preload=True, verbose=False)
+    expected = mne_subset(full).crop(1.3, 3.7)
+
+    raw = bdf_reader.read_raw_subset(path, tmin=1.3, tmax=3.7)
+    assert raw.ch_names == expected.ch_names
+    assert raw.first_samp == expected.first_samp
+    assert raw.info['meas_date'] == full.info['meas_date']
+    np.testing.assert_array_equal(raw.get_data(), expected.get_data())
+
+    # Events on the crop and on the Status-only pass line up with MNE's
+    status = raw.get_data(bdf_reader.STATUS_CHANNEL)[0].astype(np.int64)
+    events, _ = bdf_reader.find_events(status, raw.first_samp)
+    np.testing.assert_array_equal(events, mne.find_events(expected, verbose=False))
+
+    sfreq, status = bdf_reader.read_status(bdf_reader.read_header(path))
+    events, dropped = bdf_reader.find_events(status)
+    assert sfreq == SFREQ and dropped == 0
+    np.testing.assert_array_equal(events, mne.find_events(full, verbose=False))
+    assert len(events) == len(TRIGGERS)
+
+
+def test_partial_last_record(tmp_path):
+    # The header counts the cut off record, only the whole ones are data
+    path = recording(tmp_path, header_records=RECORDS + 1, partial_bytes=100)
+    full = mne.io.read_raw_bdf(path, preload=True, verbose=False)
+    expected = mne_subset(full)
+
+    raw = bdf_reader.read_raw_subset(path)
+    assert raw.n_times == SFREQ * RECORDS == expected.n_times
+    np.testing.assert_array_equal(raw.get_data(), expected.get_data())
+
+    sfreq, status = bdf_reader.read_status(bdf_reader.read_header(path))
+    events, _ = bdf_reader.find_events(status)
+    np.testing.assert_array_equal(events, mne.find_events(full, verbose=False))
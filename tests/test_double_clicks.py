@@ -0,0 +1,67 @@
+import os
+from datetime import datetime, timezone
+import numpy as np
+import mne
+
+import bdf_reader
+import eeg_shared
+import tone_sequences
+
+SFREQ = 2048
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TONE_DIR = os.path.join(REPO, 'MMN_tone_sequences')
+# What the recording played, and what the day of year would guess instead
+PLAYED = os.path.join('south', 'MMN_roving_with_trigger_dpdb02_seed_102_31-May-2014_tone_sequence.txt')
+GUESSED = os.path.join('south', 'MMN_roving_with_trigger_dpdb02_seed_101_31-May-2014_tone_sequence.txt')
+
+
+def double_click_recording(tmp_path, lead_seconds=30):
+    # A click every 0.5s, oddballs followed by a second click 10ms later
+    _, deviant = tone_sequences.lookup(TONE_DIR, os.path.join(TONE_DIR, PLAYED))
+    deviant = deviant[:2000]
+    n_times = int((lead_seconds + 1000 + 30) * SFREQ)
+    status = np.zeros(n_times)
+    onsets = ((lead_seconds + np.arange(2000) * 0.5) * SFREQ).astype(int)
+    for onset, marked in zip(onsets, deviant):
+        status[onset:onset + 4] = 1
+        if marked:
+            second = onset + int(0.01 * SFREQ)
+            status[second:second + 4] = 1
+
+    names = ['EXG1', 'EXG2', 'EXG3', 'EXG4', 'EXG5', 'EXG6', bdf_reader.STATUS_CHANNEL]
+    info = mne.create_info(names, SFREQ, ['eeg'] * 6 + ['stim'])
+    data = np.zeros((len(names), n_times))
+    data[-1] = status
+    raw = mne.io.RawArray(data, info, verbose=False)
+    # An even day of year in the afternoon guesses seed 101
+    raw.set_meas_date(datetime(2014, 6, 3, 14, 0, tzinfo=timezone.utc))
+
+    f = eeg_shared.BDFWithMetadata(str(tmp_path / "subject.bdf"), "mmn", force=True,
+            interactive=False, is_2013I=True, match_tones=True)
+    f.script_dir = REPO
+    f.raw = raw
+    return f, onsets, deviant
+
+
+def test_double_clicks_are_folded_and_labelled(tmp_path):
+    f, onsets, deviant = double_click_recording(tmp_path)
+    f.locate_events(2000, 1000, f.kind)
+
+    assert len(f.events) == 2000
+    np.testing.assert_array_equal(f.events[:, 0], onsets)
+    np.testing.assert_array_equal(f.oddball_marks, deviant)
+
+    f.load_event_tones_for_mmn()
+    assert f.tone_sequence == PLAYED
+    labels = np.where(deviant[1:], eeg_shared.DEVIANT, eeg_shared.STANDARD)
+    np.testing.assert_array_equal(f.events[1:, 2], labels)
+
+
+def test_without_matching_day_of_year_is_used(tmp_path):
+    f, onsets, _ = double_click_recording(tmp_path)
+    f.match_tones = False
+    f.locate_events(2000, 1000, f.kind)
+    np.testing.assert_array_equal(f.events[:, 0], onsets)
+
+    f.load_event_tones_for_mmn()
+    assert f.tone_sequence == GUESSED
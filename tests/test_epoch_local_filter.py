@@ -0,0 +1,60 @@
+import logging
+import numpy as np
+import mne
+
+import eeg_filters
+
+SFREQ = 16384
+# The ABR band and epoch window, see BDFWithMetadata
+L_FREQ, H_FREQ = 100, 3000
+TMIN, TMAX = -0.002, 0.010
+
+
+def noise_raw(seconds):
+    rng = np.random.default_rng(0)
+    info = mne.create_info(['Cz', 'Fz'], SFREQ, 'eeg')
+    return mne.io.RawArray(rng.standard_normal((2, int(seconds * SFREQ))) * 1e-6, info, verbose=False)
+
+
+def click_events(raw, spacing):
+    onsets = np.arange(int(0.5 * SFREQ), raw.n_times - int(0.5 * SFREQ), int(spacing * SFREQ))
+    return np.column_stack([onsets, np.zeros_like(onsets), np.ones_like(onsets)])
+
+
+def window_mask(raw, events):
+    mask = np.zeros(raw.n_times, dtype=bool)
+    for onset in events[:, 0]:
+        mask[onset + int(round(TMIN * SFREQ)):onset + int(round(TMAX * SFREQ)) + 1] = True
+    return mask
+
+
+def test_sparse_events_filter_only_their_windows(caplog):
+    raw = noise_raw(10)
+    events = click_events(raw, 1.0)
+    expected = raw.copy().filter(L_FREQ, H_FREQ, fir_design='firwin', verbose=False).get_data()
+    original = raw.get_data()
+
+    with caplog.at_level(logging.INFO):
+        eeg_filters.filter_around_events(raw, events, TMIN, TMAX, L_FREQ, H_FREQ)
+    assert "segments around events" in caplog.text
+    assert "filtering all of it" not in caplog.text
+
+    data = raw.get_data()
+    inside = window_mask(raw, events)
+    np.testing.assert_allclose(data[:, inside], expected[:, inside], atol=1e-12)
+    # Most of the recording was never touched, that's the work saved
+    changed = np.any(data != original, axis=0)
+    assert changed.mean() < 0.25
+
+
+def test_dense_clicks_fall_back_to_the_whole_recording(caplog):
+    # ABR clicks every 50ms, the padding bridges every gap
+    raw = noise_raw(5)
+    events = click_events(raw, 0.05)
+    expected = raw.copy().filter(L_FREQ, H_FREQ, fir_design='firwin', verbose=False).get_data()
+
+    with caplog.at_level(logging.INFO):
+        eeg_filters.filter_around_events(raw, events, TMIN, TMAX, L_FREQ, H_FREQ)
+    assert "filtering all of it" in caplog.text
+    np.testing.assert_allclose(raw.get_data(), expected, atol=1e-12)
+    assert raw.info['highpass'] == L_FREQ and raw.info['lowpass'] == H_FREQ
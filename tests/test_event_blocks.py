@@ -0,0 +1,54 @@
+import numpy as np
+
+import eeg_shared
+
+SFREQ = 16384
+BUFFER = eeg_shared.BUFFER_SECONDS
+
+
+def first_block_by_scanning(onsets, sfreq, expected_events, expected_duration):
+    # The one event at a time search locate_events used to do
+    skipped_events = 0
+    while len(onsets) - skipped_events >= expected_events:
+        tstart = (onsets[skipped_events] - (sfreq * BUFFER)) / sfreq
+        tstop = (onsets[skipped_events + expected_events - 1] + (sfreq * BUFFER)) / sfreq
+        duration_seconds = tstop - tstart
+        if duration_seconds > expected_duration - BUFFER * 2 and \
+            duration_seconds < expected_duration + BUFFER * 2:
+            return skipped_events
+        skipped_events += 1
+    return None
+
+
+def recording_onsets(rng):
+    # Spurious triggers, a 2000 event block every ~0.6s, then more junk
+    junk = np.sort(rng.integers(0, 60 * SFREQ, 300))
+    block = 60 * SFREQ + np.cumsum(rng.integers(int(0.55 * SFREQ), int(0.65 * SFREQ), 2000))
+    tail = block[-1] + np.sort(rng.integers(SFREQ, 120 * SFREQ, 300))
+    return np.concatenate([junk, block, tail])
+
+
+def test_matches_scanning_one_event_at_a_time():
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        onsets = recording_onsets(rng)
+        expected_events = 2000
+        true_duration = (onsets[300 + expected_events - 1] - onsets[300]) / SFREQ + BUFFER * 2
+        # Nudge the expected duration around so the edges of the tolerance get hit too
+        for expected_duration in true_duration + rng.uniform(-3, 3, 20):
+            starts, durations = eeg_shared.find_event_blocks(onsets, SFREQ, expected_events, expected_duration)
+            first = first_block_by_scanning(onsets, SFREQ, expected_events, expected_duration)
+            if first is None:
+                assert len(starts) == 0
+                continue
+            # locate_events crops to the earliest window by default
+            assert starts.min() == first
+
+            # Every window the scan would have accepted, ranked by fit
+            misfit = np.abs(durations - expected_duration)
+            assert np.all(np.diff(misfit) >= 0)
+            assert np.all(misfit < BUFFER * 2)
+            for start in range(len(onsets) - expected_events + 1):
+                fits = first_block_by_scanning(onsets[start:start + expected_events], SFREQ,
+                        expected_events, expected_duration) == 0
+                assert fits == (start in starts)
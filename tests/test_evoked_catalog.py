@@ -0,0 +1,31 @@
+import numpy as np
+import mne
+
+import evoked_catalog
+
+
+def save(directory, name, reference=None):
+    directory.mkdir(parents=True, exist_ok=True)
+    info = mne.create_info(['Cz'], 512., 'eeg')
+    evoked = mne.EvokedArray(np.zeros((1, 10)), info, nave=5)
+    if reference is not None:
+        evoked_catalog.describe_reference(evoked, reference)
+    path = directory / name
+    mne.write_evokeds(str(path), evoked)
+    return str(path)
+
+
+def test_rebuild_keeps_noted_reference(tmp_path):
+    root = tmp_path / "eeg_statistics"
+    # --no-reference saves to the same directory as both mastoids
+    unreferenced = save(root / "mmn" / "subject1", "subject1.mmn-standard-ave.fif", "none")
+    older = save(root / "mmn" / "subject2", "subject2.mmn-standard-ave.fif")
+    o1 = save(root / "mmn-o1" / "subject3", "subject3.mmn-standard-ave.fif", "o1")
+
+    catalog = evoked_catalog.EvokedCatalog(str(tmp_path / "catalog.sqlite"))
+    assert catalog.rebuild(str(root)) == 3
+    assert catalog.find("subject1", "mmn", "standard", reference="both") is None
+    assert catalog.find("subject1", "mmn", "standard", reference="none") == unreferenced
+    # Saved before the reference was noted, the directory is all there is
+    assert catalog.find("subject2", "mmn", "standard", reference="both") == older
+    assert catalog.find("subject3", "mmn", "standard", reference="o1") == o1
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import mne
+
+import eeg_filters
+
+NOTCH = np.arange(50, 251, 50)
+
+
+def noisy_raw(sfreq, seconds):
+    # Noise plus mains hum at 50Hz and its third harmonic
+    rng = np.random.default_rng(0)
+    times = np.arange(int(seconds * sfreq)) / sfreq
+    hum = 20e-6 * np.sin(2 * np.pi * 50 * times) + 5e-6 * np.sin(2 * np.pi * 150 * times)
+    data = rng.standard_normal((2, len(times))) * 1e-6 + hum
+    info = mne.create_info(['Cz', 'Fz'], sfreq, 'eeg')
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def check_against_two_passes(raw, l_freq, h_freq, kernel_dir=None):
+    sfreq = raw.info['sfreq']
+    expected = raw.copy().notch_filter(NOTCH, verbose=False)
+    expected.filter(l_freq, h_freq, fir_design='firwin', verbose=False)
+
+    kernel = eeg_filters.fused_kernel(sfreq, l_freq, h_freq, NOTCH, kernel_dir)
+    fused = eeg_filters.apply_kernel(raw.copy(), kernel, l_freq, h_freq)
+
+    peak = np.abs(expected.get_data()).max()
+    np.testing.assert_allclose(fused.get_data(), expected.get_data(), rtol=0, atol=1e-9 * peak)
+    assert fused.info['highpass'] == expected.info['highpass']
+    assert fused.info['lowpass'] == expected.info['lowpass']
+
+
+def test_mmn_band_matches_notch_then_filter(tmp_path):
+    check_against_two_passes(noisy_raw(2048, 30), 1, 35, str(tmp_path))
+    # A new process would load it from disk, the same kernel
+    eeg_filters._kernels.clear()
+    entries = os.listdir(tmp_path)
+    assert len(entries) == 1 and entries[0].startswith("kernel_")
+    check_against_two_passes(noisy_raw(2048, 30), 1, 35, str(tmp_path))
+
+
+def test_abr_band_matches_notch_then_filter():
+    check_against_two_passes(noisy_raw(16384, 8), 100, 3000)
+
+
+def test_overlap_add_is_valid_convolution():
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((3, 5000))
+    kernel = rng.standard_normal(301)
+    expected = np.array([np.convolve(row, kernel, mode='valid') for row in x])
+    np.testing.assert_allclose(eeg_filters.overlap_add(x, kernel, {}), expected, atol=1e-10)
@@ -0,0 +1,73 @@
+import numpy as np
+import mne
+
+import eeg_filters
+import eeg_shared
+
+SFREQ = 16384
+# Where the manual process ended up, see decimate_epochs
+TARGET_SFREQ = 512
+# Of each average's peak. The difference is event onsets rounding to the
+# 512Hz grid, 0.1-0.5% here.
+TOLERANCE = 0.01
+
+
+def mmn_recording(seconds=90):
+    # Standards every 0.6s with a deviant every fifth, each followed by a
+    # smooth ERP (bigger and later for deviants) on top of some noise
+    rng = np.random.default_rng(0)
+    n = int(seconds * SFREQ)
+    onsets = np.arange(int(1 * SFREQ), n - int(1 * SFREQ), int(0.6 * SFREQ))
+    # Off the 512Hz grid, like real triggers
+    onsets += rng.integers(0, 32, len(onsets))
+    ids = np.where(np.arange(len(onsets)) % 5 == 4, eeg_shared.DEVIANT, eeg_shared.STANDARD)
+    # The first tone has nothing before it to tell which it is
+    ids[0] = eeg_shared.UNKNOWN
+
+    t = np.arange(int(0.4 * SFREQ)) / SFREQ
+    erp = {
+        eeg_shared.UNKNOWN: -2e-6 * np.exp(-((t - 0.10) / 0.02) ** 2),
+        eeg_shared.STANDARD: -2e-6 * np.exp(-((t - 0.10) / 0.02) ** 2),
+        eeg_shared.DEVIANT: -5e-6 * np.exp(-((t - 0.15) / 0.03) ** 2),
+    }
+    signal = np.zeros(n)
+    for onset, event_id in zip(onsets, ids):
+        signal[onset:onset + len(t)] += erp[event_id]
+
+    channels = len(eeg_shared.EPOCH_CHANNELS)
+    data = np.tile(signal, (channels, 1)) + rng.standard_normal((channels, n)) * 0.5e-6
+    info = mne.create_info(eeg_shared.EPOCH_CHANNELS, SFREQ, 'eeg')
+    raw = mne.io.RawArray(data, info, verbose=False)
+    events = np.column_stack([onsets, np.zeros_like(onsets), ids])
+    return raw, events
+
+
+def averages(tmp_path, raw, events, resample):
+    f = eeg_shared.BDFWithMetadata(str(tmp_path / "subject.bdf"), "mmn", force=True,
+            interactive=False, stage_reference_path=str(tmp_path / "stage_times.yaml"))
+    f.events = events
+    if resample:
+        # What load_file does right after the crop with --resample
+        f.source_sfreq = raw.info['sfreq']
+        f.raw = eeg_filters.resample_raw(raw, TARGET_SFREQ)
+    else:
+        f.raw = raw.copy()
+    f.build_epochs()
+    f.decimate_epochs()
+    return f.average_epochs(f.epochs)
+
+
+def test_early_resample_matches_late_decimation(tmp_path):
+    raw, events = mmn_recording()
+    early = averages(tmp_path, raw, events, resample=True)
+    late = averages(tmp_path, raw, events, resample=False)
+
+    for name in ["deviant", "standard", "all"]:
+        assert early[name].info['sfreq'] == TARGET_SFREQ
+        assert early[name].nave == late[name].nave
+        # Late decimation leaves 16384/3Hz, put it on the 512Hz grid to compare
+        late_data = np.array([np.interp(early[name].times, late[name].times, row)
+                for row in late[name].data])
+        peak = np.abs(late[name].data).max()
+        error = np.abs(early[name].data - late_data).max()
+        assert error < TOLERANCE * peak, f"{name} differs by {error / peak:.2%} of the peak"
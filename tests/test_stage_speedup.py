@@ -0,0 +1,40 @@
+import time
+import numpy as np
+import mne
+
+import eeg_shared
+
+
+def subject(tmp_path, jobs, seconds):
+    f = eeg_shared.BDFWithMetadata(str(tmp_path / "subject.bdf"), "mmn", force=True,
+            interactive=False, jobs=jobs, stage_reference_path=str(tmp_path / "stage_times.yaml"))
+    info = mne.create_info(eeg_shared.EPOCH_CHANNELS, 1024, 'eeg')
+    f.raw = mne.io.RawArray(np.zeros((len(eeg_shared.EPOCH_CHANNELS), int(seconds * 1024))), info, verbose=False)
+    return f
+
+
+def test_speedup_against_single_job_reference(tmp_path):
+    f = subject(tmp_path, 4, 10)
+    with f.stage("Notch filter"):
+        pass
+    # No single-job run yet, so nothing to compare with
+    assert f.stage_speedups == {}
+
+    f = subject(tmp_path, 1, 10)
+    with f.stage("Notch filter"):
+        time.sleep(0.4)
+
+    # Twice the data in the same time as one job took for half of it
+    f = subject(tmp_path, 4, 20)
+    with f.stage("Notch filter"):
+        time.sleep(0.4)
+    assert 1.6 < f.stage_speedups["Notch filter"] < 2.1
+
+
+def test_old_positional_force_is_rejected(tmp_path):
+    try:
+        eeg_shared.BDFWithMetadata(str(tmp_path / "subject.bdf"), "mmn", True)
+    except TypeError as e:
+        assert "force=True" in str(e)
+    else:
+        assert False, "expected a TypeError"
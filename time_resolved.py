@@ -0,0 +1,144 @@
+import os
+import logging
+import numpy as np
+from scipy import stats
+import mne
+from matplotlib import pyplot as plt
+
+# Group comparison at every sample of every channel, instead of on one
+# window's area at a time. The two groups' subject x channel x time arrays
+# (see group_store) are tested in one pass with the same weighted Welch t-test
+# the analysis scripts run through statsmodels, and the p values are FDR
+# corrected across all channels and samples together.
+#
+# Results are saved as time_resolved.npz with t, p, dof and the FDR mask
+# (all channel x time), the times and channel names, and plotted next to it.
+
+RESULT_NAME = "time_resolved.npz"
+
+
+def trial_weights(nave, keep=None):
+    """
+    Weights by number of trials not rejected, as the analysis scripts
+    calculate them, for subject x channel arrays. keep (subject x channel,
+    optional) marks the data to use, other subjects get no weight on that
+    channel and the rest are weighted as if they weren't there.
+    """
+    nave = np.asarray(nave, dtype=float)
+    if keep is None:
+        keep = np.ones((len(nave), 1), dtype=bool)
+    kept = nave[:, None] * keep
+    return kept / kept.sum(axis=0) * keep.sum(axis=0)
+
+
+def describe(data, weights):
+    # Weighted mean and squared standard error along the subject axis, like
+    # statsmodels DescrStatsW, where the number of observations is the sum
+    # of the weights and the variance has ddof=0
+    weights = np.asarray(weights, dtype=float)
+    weights = weights.reshape(weights.shape + (1,) * (data.ndim - weights.ndim))
+    nobs = weights.sum(axis=0)
+    mean = (weights * data).sum(axis=0) / nobs
+    var = (weights * (data - mean) ** 2).sum(axis=0) / nobs
+    return mean, var / (nobs - 1), nobs
+
+
+def weighted_welch(group1, group2, weights1, weights2):
+    """
+    statsmodels ttest_ind(group1, group2, usevar='unequal', weights=(weights1,
+    weights2)) at every point of subject x ... arrays at once. Weights are
+    per subject, or subject x channel. Returns t, p and degrees of freedom.
+    """
+    mean1, sem1, nobs1 = describe(np.asarray(group1, dtype=float), weights1)
+    mean2, sem2, nobs2 = describe(np.asarray(group2, dtype=float), weights2)
+    semsum = sem1 + sem2
+    # Satterthwaite degrees of freedom
+    dof = 1 / ((sem1 / semsum) ** 2 / (nobs1 - 1) + (sem2 / semsum) ** 2 / (nobs2 - 1))
+    t = (mean1 - mean2) / np.sqrt(semsum)
+    p = 2 * stats.t.sf(np.abs(t), dof)
+    return t, p, dof
+
+
+def group_test(group1, group2, weights1, weights2, alpha=0.05):
+    """
+    weighted_welch on two subject x channel x time arrays, with the p values
+    FDR corrected (Benjamini-Hochberg) over every channel and sample.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t, p, dof = weighted_welch(group1, group2, weights1, weights2)
+    # Flat stretches (like a channel that is all zeros) can't be tested
+    untested = ~np.isfinite(p)
+    if np.any(untested):
+        logging.warning(f"{untested.sum()} of {p.size} samples have no variance to test, counting them as p=1")
+    significant, p_fdr = mne.stats.fdr_correction(np.where(untested, 1.0, p), alpha=alpha)
+    logging.info(f"{significant.sum()} of {p.size} channel samples differ at FDR {alpha}")
+    return {
+        't': t,
+        'p': p,
+        'dof': dof,
+        'p_fdr': p_fdr,
+        'significant': significant,
+        'alpha': alpha,
+    }
+
+
+def save(directory, result, times, ch_names):
+    path = os.path.join(directory, RESULT_NAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, times=times, ch_names=np.array(ch_names), **result)
+    os.replace(tmp_path, path)
+    logging.info(f"Time resolved t test saved to {path}")
+    return path
+
+
+def significant_spans(times, mask):
+    # (start, end) times of each run of significant samples
+    edges = np.diff(np.concatenate([[0], mask.astype(int), [0]]))
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0] - 1
+    return [(times[s], times[e]) for s, e in zip(starts, ends)]
+
+
+def plot(directory, result, times, ch_names, title, electrodes=()):
+    """
+    Save a channel x time map of t with the FDR significant samples in full
+    colour, and t over time for each of electrodes with the significant
+    stretches shaded.
+    """
+    ms = times * 1000
+    limit = np.nanmax(np.abs(result['t'])) if np.any(np.isfinite(result['t'])) else 1
+
+    fig, ax = plt.subplots(figsize=(8, max(3, len(ch_names) / 6)))
+    kwargs = dict(aspect='auto', origin='lower', cmap='RdBu_r', vmin=-limit, vmax=limit,
+            interpolation='nearest', extent=(ms[0], ms[-1], -0.5, len(ch_names) - 0.5))
+    # Faded everywhere, full colour where significant
+    ax.imshow(result['t'], alpha=0.25, **kwargs)
+    image = ax.imshow(np.ma.masked_where(~result['significant'], result['t']), **kwargs)
+    ax.set_yticks(np.arange(len(ch_names)))
+    ax.set_yticklabels(ch_names, fontsize=6)
+    ax.set_xlabel("Time (ms)")
+    ax.set_title(f"{title}, solid where p < {result['alpha']} FDR")
+    fig.colorbar(image, ax=ax, label="t")
+    filename = os.path.join(directory, "time_resolved.png")
+    fig.savefig(filename, dpi=300, bbox_inches="tight")
+    plt.close(fig)
+    logging.info(f"Time resolved t map saved to {filename}")
+
+    for electrode in electrodes:
+        pick = ch_names.index(electrode)
+        fig, ax = plt.subplots(figsize=(4, 8/3))
+        ax.plot(ms, result['t'][pick], color='k', linewidth=0.75)
+        ax.axhline(0, color='grey', linewidth=0.5)
+        # Half a sample either side so single samples show up
+        half = (ms[1] - ms[0]) / 2
+        for start, end in significant_spans(ms, result['significant'][pick]):
+            ax.axvspan(start - half, end + half, color='tab:red', alpha=0.3, linewidth=0)
+        ax.set_xlim(ms[0], ms[-1])
+        ax.set_xlabel("Time (ms)")
+        ax.set_ylabel("t")
+        ax.set_title(f"{title} on {electrode}", fontsize=8)
+        filename = os.path.join(directory, f"time_resolved_{electrode}.png")
+        fig.savefig(filename, dpi=300, bbox_inches="tight")
+        plt.close(fig)
+        logging.info(f"Time resolved t on {electrode} saved to {filename}")
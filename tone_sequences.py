@@ -0,0 +1,177 @@
+import os
+import glob
+import logging
+import numpy as np
+
+# The MMN tone sequence text files are one long CSV line of tone numbers each.
+# Parsing them for every file adds up across a cohort, so we compile all of
+# them once into a single .npz next to the text files, with the
+# standard/deviant labels already worked out. Batch workers then just load
+# (or inherit) the arrays.
+
+INDEX_FILE = "tone_sequences.npz"
+
+# Compiled indexes already loaded in this process, by tone directory
+_loaded = {}
+
+
+def sequence_files(tone_dir):
+    return sorted(glob.glob(os.path.join(tone_dir, '*', '*_tone_sequence.txt')))
+
+
+def read_sequence_file(path):
+    with open(path) as file:
+        # NOTE: there are way more than 2000 entries because of... legacy reasons
+        return np.array([int(x) for x in file.readline().strip().split(',')], dtype=np.int8)
+
+
+def compile_index(tone_dir):
+    files = sequence_files(tone_dir)
+    if len(files) == 0:
+        raise FileNotFoundError(f"No tone sequence files found in {tone_dir}")
+
+    sequences = [read_sequence_file(f) for f in files]
+    lengths = np.array([len(s) for s in sequences])
+    tones = np.zeros((len(sequences), lengths.max()), dtype=np.int8)
+    for i, s in enumerate(sequences):
+        tones[i, :len(s)] = s
+
+    # A tone is deviant when it differs from the one before it,
+    # the first tone has nothing to compare to so it is neither
+    deviant = np.zeros(tones.shape, dtype=bool)
+    deviant[:, 1:] = tones[:, 1:] != tones[:, :-1]
+    for i, n in enumerate(lengths):
+        deviant[i, n:] = False
+
+    names = np.array([os.path.relpath(f, tone_dir) for f in files])
+    return {
+        'names': names,
+        'tones': tones,
+        'lengths': lengths,
+        'deviant': deviant,
+    }
+
+
+def is_stale(tone_dir, index_path):
+    if not os.path.exists(index_path):
+        return True
+    built = os.path.getmtime(index_path)
+    return any(os.path.getmtime(f) > built for f in sequence_files(tone_dir))
+
+
+def load_index(tone_dir):
+    tone_dir = os.path.abspath(tone_dir)
+    if tone_dir in _loaded:
+        return _loaded[tone_dir]
+
+    index_path = os.path.join(tone_dir, INDEX_FILE)
+    if is_stale(tone_dir, index_path):
+        logging.info(f"Compiling tone sequences in {tone_dir}")
+        index = compile_index(tone_dir)
+        try:
+            # Write then rename so parallel workers never see half a file
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                np.savez(file, **index)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            # Shared installs may not be writable, the in-memory copy is fine
+            logging.warning(f"Could not save tone sequence index to {index_path}: {e}")
+    else:
+        with np.load(index_path) as data:
+            index = {k: data[k] for k in data.files}
+
+    _loaded[tone_dir] = index
+    return index
+
+
+def lookup(tone_dir, path):
+    """
+    Get the tones and deviant flags for one sequence file, by path.
+    """
+    index = load_index(tone_dir)
+    name = os.path.relpath(os.path.abspath(path), os.path.abspath(tone_dir))
+    matches = np.flatnonzero(index['names'] == name)
+    if len(matches) == 0:
+        raise FileNotFoundError(f"Tone sequence {path} is not in the index for {tone_dir}")
+    i = matches[0]
+    n = index['lengths'][i]
+    return index['tones'][i, :n], index['deviant'][i, :n]
+
+
+# The 2014 (dpdb02) sequences mark each oddball with a second trigger click
+# 220 samples at 44.1kHz (5ms) after the first, see oddball_for_Tukdam_AL_DMP_edit.m.
+# Anything closer together than this is treated as one of those pairs.
+DOUBLE_CLICK_SECONDS = 0.02
+# Files with these double clicks, the only ones a match can really come from
+DOUBLE_CLICK_FILES = "dpdb02"
+
+# How sure we need to be before trusting a match over the day of year guess
+MIN_MATCH_SCORE = 0.95
+MIN_MATCH_MARGIN = 0.05
+
+
+def fold_double_clicks(onsets, sfreq):
+    """
+    Fold the second click of each oddball pair into the tone it belongs to.
+
+    Returns (keep, marked): which onsets start a tone, and for each of those
+    whether it was followed by a second click (marked as an oddball).
+    """
+    onsets = np.asarray(onsets)
+    second_click = np.zeros(len(onsets), dtype=bool)
+    second_click[1:] = np.diff(onsets) / sfreq < DOUBLE_CLICK_SECONDS
+    marked = np.zeros(len(onsets), dtype=bool)
+    marked[:-1] = second_click[1:]
+    return ~second_click, marked[~second_click]
+
+
+def match(observed, tone_dir, preferred=None):
+    """
+    Score every tone sequence against the oddball marks of the recorded tones
+    (from fold_double_clicks) in one pass.
+
+    Candidates that are too short for the number of tones recorded score
+    zero, the rest score the fraction of tones whose oddball marking agrees.
+    Returns (path, score, margin) where margin is how far ahead of the next
+    different sequence the best one is, or None if the recording has no
+    oddball markers to go on (the 2012 dpdb01 sequences only have one click
+    per tone, so timing can't tell them apart).
+
+    Files with the same seed hold the same sequence, if preferred is one of
+    the equally good files it is the one returned, otherwise a dpdb02 one.
+    """
+    index = load_index(tone_dir)
+    observed = np.asarray(observed, dtype=bool)
+    n = len(observed)
+    if n == 0 or not observed.any():
+        logging.warning("No oddball double clicks in the event timing (dpdb01 sequences have one click per tone), can't match the tone sequence by timing")
+        return None
+
+    deviant = index['deviant']
+    if deviant.shape[1] < n:
+        deviant = np.pad(deviant, ((0, 0), (0, n - deviant.shape[1])))
+    scores = np.mean(deviant[:, :n] == observed[np.newaxis, :], axis=1)
+    scores[index['lengths'] < n] = 0
+
+    best = int(np.argmax(scores))
+    # North and south have identical copies of the 2012 sequences,
+    # only compare against sequences that would label events differently
+    same = np.all(index['deviant'] == index['deviant'][best], axis=1)
+    others = scores[~same]
+    margin = scores[best] - (others.max() if len(others) else 0)
+
+    names = index['names'].astype(str)
+    candidates = [np.char.find(names, DOUBLE_CLICK_FILES) >= 0]
+    if preferred is not None:
+        name = os.path.relpath(os.path.abspath(preferred), os.path.abspath(tone_dir))
+        candidates.insert(0, names == name)
+    for candidate in candidates:
+        equal = np.flatnonzero(same & candidate)
+        if len(equal) > 0:
+            best = int(equal[0])
+            break
+
+    path = os.path.join(os.path.abspath(tone_dir), str(index['names'][best]))
+    logging.info(f"Best tone sequence match is {index['names'][best]} with score {scores[best]:.3f} and margin {margin:.3f}")
+    return path, float(scores[best]), float(margin)